@@ -0,0 +1,5 @@
+import sys
+
+from insta_reddit.cli import main
+
+sys.exit(main())
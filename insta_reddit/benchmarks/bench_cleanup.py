@@ -0,0 +1,74 @@
+"""
+Benchmark cleanup_content against the original row-wise implementation
+python insta_reddit/benchmarks/bench_cleanup.py --sizes 1000,10000,100000
+"""
+import argparse
+import html
+import random
+import sys
+import time
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+import pandas as pd
+from insta_reddit.code.download_from_reddit import cleanup_content
+
+WORDS = ["you", "the", "to", "a", "free", "food", "store", "manager", "&amp;", "&gt;", "ask",
+         "coupon", "return", "receipt", "always", "never", "request", "when", "your", "friends"]
+
+
+def make_content_df(size, seed=0):
+    """ Synthetic posts with titles of varied length, some of them requests or with entities
+    """
+    rng = random.Random(seed)
+    titles = ["ULPT: " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 120)))
+              for _ in range(size)]
+    return pd.DataFrame({"title": titles,
+                         "selftext": [""] * size,
+                         "author": ["someone"] * size,
+                         "url": ["https://redd.it/{}".format(i) for i in range(size)],
+                         "id": [str(i) for i in range(size)]})
+
+
+def cleanup_content_rowwise(content_df, colnames=None):
+    """ The original implementation, applying a Python function row by row
+    """
+    if colnames is None:
+        colnames = ['title']
+
+    def cleanup_ulpt_text(text):
+        if "request" not in text.lower():
+            text = text[text.find(' '):]
+            return None if len(text) < 20 or len(text) > 500 else html.unescape(text)
+        return None
+
+    for colname in colnames:
+        content_df[colname] = content_df.apply(lambda row: cleanup_ulpt_text(row[colname]), axis=1)
+    return content_df.dropna()
+
+
+def time_it(func, content_df):
+    start = time.perf_counter()
+    result = func(content_df.copy())
+    return time.perf_counter() - start, result
+
+
+def main(args):
+    for size in [int(size) for size in args.sizes.split(",")]:
+        content_df = make_content_df(size)
+        rowwise_seconds, expected = time_it(cleanup_content_rowwise, content_df)
+        vectorized_seconds, result = time_it(cleanup_content, content_df)
+        if not expected.astype(object).equals(result.astype(object)):
+            raise AssertionError("Vectorized cleanup differs from the row-wise one at size {}"
+                                 .format(size))
+        print("{:>8} rows: row-wise {:.3f}s, vectorized {:.3f}s, {:.1f}x faster".format(
+            size, rowwise_seconds, vectorized_seconds, rowwise_seconds / vectorized_seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', dest='sizes', default="1000,10000,100000",
+                        help="""Comma-separated numbers of posts to benchmark with""")
+    main(args=parser.parse_args())
+    sys.exit(0)
@@ -0,0 +1,62 @@
+"""
+Check the import time of every CLI command against its budget
+Each command is imported in a fresh interpreter, as cron would run it.
+Exits with 1 if a command goes over its budget or imports a module it shouldn't need.
+python insta_reddit/benchmarks/bench_import_time.py
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+
+HEAVY_MODULES = ["pandas", "praw", "nltk", "instabot", "gspread", "PIL"]
+
+# command: (budget in seconds, heavy modules it may import)
+BUDGETS = {
+    "status": (0.5, ["gspread"]),
+    "caption": (0.5, ["gspread"]),
+    "upload": (0.5, ["gspread"]),
+    "compact": (0.5, []),
+    "render": (1.0, ["gspread", "PIL"]),
+    "fetch": (3.0, ["gspread", "pandas", "praw"]),
+    "run": (5.0, HEAVY_MODULES),
+}
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+from insta_reddit import cli
+cli.load_command(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure(command):
+    """ Import time and heavy modules loaded by a command, in a fresh interpreter
+    """
+    output = subprocess.run([sys.executable, "-c", MEASURE, command], cwd=git_root,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    failed = False
+    for command, (budget, allowed) in BUDGETS.items():
+        result = measure(command)
+        unexpected = [module for module in result["modules"] if module not in allowed]
+        ok = result["seconds"] * args.scale <= budget and not unexpected
+        failed = failed or not ok
+        print("{:<8} {:.3f}s (budget {:.1f}s) {}{}".format(
+            command, result["seconds"], budget, "ok" if ok else "FAILED",
+            " unexpected imports: {}".format(", ".join(unexpected)) if unexpected else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', dest='scale', type=float, default=1.0,
+                        help="""Multiply the measured times, e.g. 0.5 on a machine twice as slow""")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,396 @@
+"""
+Offline stand-ins for Google Sheets, Reddit and Instagram, plus synthetic posts to feed them
+They count the API calls they receive, so benchmarks can report calls as well as time.
+"""
+import importlib
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from unittest import mock
+
+from gspread.utils import a1_to_rowcol
+
+WORDS = ["you", "the", "to", "a", "free", "food", "store", "manager", "&amp;", "&gt;", "ask",
+         "coupon", "return", "receipt", "always", "never", "request", "when", "your", "friends",
+         "subscription", "cancel", "discount", "airline", "hotel", "upgrade", "politely", "email"]
+SHEET_HEADER = ["title", "selftext", "author", "url", "id", "image_uploaded"]
+
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
+
+
+def make_vocabulary(size, rng):
+    """ WORDS plus made up words, so unrelated titles share as little as real ones do
+    """
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return WORDS + ["".join(rng.choice(letters) for _ in range(rng.randint(2, 10)))
+                    for _ in range(size)]
+
+
+def make_posts(count, seed=0, start_id=10 ** 6, start_utc=1.6e9, repost_fraction=0.0):
+    """
+    Synthetic Reddit posts, newest first, as dicts of the listing fields
+    Titles vary in length, some are requests or carry HTML entities, some have a selftext
+    :param int count:               Number of posts
+    :param int seed:                Seed of the random generator, for reproducible runs
+    :param float repost_fraction:   Share of the posts repeating an earlier title, reworded slightly
+    :rtype: list(dict)
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(5000, rng)
+    titles = []
+    posts = []
+    for i in range(count):
+        if titles and rng.random() < repost_fraction:
+            words = rng.choice(titles).split(" ")
+            words[rng.randrange(1, len(words))] = rng.choice(vocabulary)
+            title = " ".join(words)
+        else:
+            title = "ULPT: " + " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 70)))
+        titles.append(title)
+        selftext = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(5, 120))) \
+            if rng.random() < 0.3 else ""
+        post_id = to_base36(start_id + i)
+        posts.append({"id": post_id,
+                      "title": title,
+                      "selftext": selftext,
+                      "author": "user_{}".format(rng.randint(1, count // 10 + 1)),
+                      "url": "https://www.reddit.com/r/UnethicalLifeProTips/comments/" + post_id,
+                      "created_utc": start_utc + i,
+                      "score": rng.randint(0, 50000)})
+    return posts[::-1]
+
+
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet:
+    """
+    In-memory stand-in for a gspread Worksheet, for the calls SheetsDb makes
+    Every call is counted in self.calls by method name
+    """
+    def __init__(self, rows=None, latency=0.0):
+        """
+        :param list rows:       Rows of the sheet including the header, defaults to just the header
+        :param float latency:   Seconds each call sleeps, to mimic the network round trip
+        """
+        self.rows = [list(row) for row in rows] if rows else [list(SHEET_HEADER)]
+        self.latency = latency
+        self.calls = Counter()
+
+    @classmethod
+    def from_posts(cls, posts, uploaded_fraction=0.9, latency=0.0):
+        """ A sheet holding the posts, the oldest ones marked as uploaded
+        """
+        rows = [list(SHEET_HEADER)]
+        uploaded_from = int(len(posts) * (1 - uploaded_fraction))
+        for i, post in enumerate(posts):
+            rows.append([post["title"], post["selftext"], post["author"], post["url"], post["id"],
+                         "TRUE" if i >= uploaded_from else ""])
+        return cls(rows, latency)
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        while len(self.rows[row - 1]) < col:
+            self.rows[row - 1].append("")
+        self.rows[row - 1][col - 1] = str(value)
+
+    def row_values(self, row):
+        self._call("row_values")
+        values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def col_values(self, col):
+        self._call("col_values")
+        values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def cell(self, row, col):
+        self._call("cell")
+        values = self.rows[row - 1] if row <= len(self.rows) else []
+        return FakeCell(values[col - 1] if len(values) >= col else "")
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        self._set(row, col, value)
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._call("update")
+        first_row, first_col = a1_to_rowcol(range_name.split(":")[0])
+        for row_offset, row in enumerate(values):
+            for col_offset, value in enumerate(row):
+                self._set(first_row + row_offset, first_col + col_offset, value)
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        for update in data:
+            first_row, first_col = a1_to_rowcol(update["range"].split(":")[0])
+            for row_offset, row in enumerate(update["values"]):
+                for col_offset, value in enumerate(row):
+                    self._set(first_row + row_offset, first_col + col_offset, value)
+
+    def batch_get(self, ranges, **kwargs):
+        """ Like the API, whole rows and columns can be asked for, e.g. "1:1" or "E:E",
+        and empty cells at the end of the rows and of the range are left out
+        """
+        self._call("batch_get")
+        results = []
+        for range_name in ranges:
+            first, _, last = range_name.partition(":")
+            (first_row, first_col), (last_row, last_col) = \
+                [self._parse_a1(cell) for cell in (first, last or first)]
+            values = [[row[col - 1] if len(row) >= col else ""
+                       for col in range(first_col or 1, (last_col or len(row)) + 1)]
+                      for row in self.rows[(first_row or 1) - 1:last_row or len(self.rows)]]
+            for row in values:
+                while row and row[-1] == "":
+                    row.pop()
+            while values and not values[-1]:
+                values.pop()
+            results.append(values)
+        return results
+
+    @staticmethod
+    def _parse_a1(cell):
+        """ (row, col) of a cell, None for the part missing from a whole row or column
+        """
+        letters = cell.rstrip("0123456789")
+        digits = cell[len(letters):]
+        col = a1_to_rowcol(letters + "1")[1] if letters else None
+        return int(digits) if digits else None, col
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        header = self.rows[0]
+        return [{name: row[i] if i < len(row) else "" for i, name in enumerate(header)}
+                for row in self.rows[1:]]
+
+
+class FakeSubmission:
+    """ Submission whose attributes are the listing data, like PRAW's non-lazy fields
+    """
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def _listing(self, limit):
+        limit = len(self.reddit.posts) if limit is None else limit
+        for i, post in enumerate(self.reddit.posts[:limit]):
+            if i % self.reddit.page_size == 0:  # One request per page of the listing
+                self.reddit.requests += 1
+                if self.reddit.latency:
+                    time.sleep(self.reddit.latency)
+            yield FakeSubmission(post)
+
+    def top(self, limit=100, time_filter="all"):
+        return self._listing(limit)
+
+    def controversial(self, limit=100, time_filter="all"):
+        return self._listing(limit)
+
+    def hot(self, limit=100):
+        return self._listing(limit)
+
+    def new(self, limit=100):
+        return self._listing(limit)
+
+    def rising(self, limit=100):
+        return self._listing(limit)
+
+
+class FakeReddit:
+    """
+    Stand-in for praw.Reddit serving the same posts for every subreddit and listing
+    self.requests counts the listing pages fetched
+    """
+    def __init__(self, posts, page_size=100, latency=0.0):
+        self.posts = posts
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = 0
+        self.read_only = True
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+
+class FakeBot:
+    """ Stand-in for instabot.Bot, recording uploads instead of posting them
+    """
+    def __init__(self, latency=0.0, **kwargs):
+        self.latency = latency
+        self.logins = 0
+        self.uploads = []
+
+    def login(self, **kwargs):
+        self.logins += 1
+        return True
+
+    def upload_photo(self, photo, caption=None, options=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.uploads.append((photo, caption))
+        return True
+
+
+def fake_hashtags_batch(texts):
+    """ Hashtags from the longest words, for when the NLTK data isn't downloaded
+    """
+    from insta_reddit.code.captions import DEFAULT_HASHTAGS, MAX_NUM_HASHTAGS
+    hashtag_strings = []
+    for text in texts:
+        words = list(dict.fromkeys(word for word in text.lower().split() if word.isalpha()))
+        words = sorted(words, key=len, reverse=True)[:MAX_NUM_HASHTAGS - 4]
+        hashtag_strings.append(("#" + " #".join(words) if words else "") + DEFAULT_HASHTAGS)
+    return hashtag_strings
+
+
+def make_credentials():
+    """ Stand-in for insta_reddit/credentials.py, so the benchmarks run on a fresh checkout
+    """
+    credentials = types.ModuleType("insta_reddit.credentials")
+    credentials.__dict__.update(
+        client_id="fake", client_secret="fake", user_agent="fake", username="fake",
+        instabot_username="fake", instabot_password="fake", sheets_url="fake",
+        storage_backend="sqlite", sheets_mirror=False, near_duplicates="skip")
+    return credentials
+
+
+@contextmanager
+def offline_environment(work_dir, font_filename, db, reddit=None, bot=None, fake_nlp=False):
+    """
+    Point the fetch, render, caption and upload modules at the fakes and at work_dir
+    Images, the manifest, the captions and the near-duplicate index are written under work_dir
+    instead of content/, and nothing is synced to the Google Sheets mirror.
+    :param str work_dir:        Folder for the generated files
+    :param str font_filename:   Font used for every text of the images
+    :param PostDb db:           DB returned by get_db()
+    :param FakeReddit reddit:   Reddit returned by initialize()
+    :param FakeBot bot:         Bot the uploader logs in with
+    :param bool fake_nlp:       Generate hashtags with fake_hashtags_batch instead of NLTK
+    """
+    credentials = make_credentials()
+    # The uploader logs in through instabot.Bot, which is the fake bot here
+    instabot = types.ModuleType("instabot")
+    bot = bot or FakeBot()
+    instabot.Bot = lambda **kwargs: bot
+    with stubbed_modules({"insta_reddit.credentials": credentials, "instabot": instabot}), \
+            _offline_environment(work_dir, font_filename, db, reddit, fake_nlp):
+        yield
+
+
+@contextmanager
+def stubbed_modules(modules):
+    """ Make imports of the modules return the stand-ins, the real ones being imported or not
+    """
+    saved = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        with ExitStack() as stack:
+            for name, module in modules.items():
+                if "." in name:  # from package import module reads the attribute first
+                    package, attribute = name.rsplit(".", 1)
+                    stack.enter_context(mock.patch.object(
+                        importlib.import_module(package), attribute, module, create=True))
+            yield
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+
+@contextmanager
+def _offline_environment(work_dir, font_filename, db, reddit, fake_nlp):
+    from insta_reddit.code import captions, draw_text_on_image, download_from_reddit, pipeline, \
+        upload_to_instagram
+    from insta_reddit.code.captions import CaptionStore
+    from insta_reddit.code.fetch_checkpoints import FetchCheckpoints
+    from insta_reddit.code.image_manifest import ImageManifest
+    from insta_reddit.code.near_duplicates import NearDuplicateIndex
+
+    local = threading.local()  # SQLite connections can't be shared across threads
+
+    def get_manifest():
+        if not hasattr(local, "manifest"):
+            local.manifest = ImageManifest(work_dir + "/manifest.db")
+        return local.manifest
+
+    def get_caption_store():
+        if not hasattr(local, "caption_store"):
+            local.caption_store = CaptionStore(work_dir + "/captions.db")
+        return local.caption_store
+
+    def get_near_duplicate_index():
+        if not hasattr(local, "near_duplicate_index"):
+            local.near_duplicate_index = NearDuplicateIndex(work_dir + "/near_duplicates.db")
+        return local.near_duplicate_index
+
+    def get_img_output_file_paths(record):
+        Path(work_dir + "/generated").mkdir(exist_ok=True)
+        return (work_dir + "/generated/title_" + record['id'] + ".jpg",
+                work_dir + "/generated/self_text_" + record['id'] + ".jpg")
+
+    image_format = dict(draw_text_on_image.get_format(), subreddit_font=font_filename,
+                        title_font=font_filename, self_text_font=font_filename)
+    uploader = upload_to_instagram.InstagramUploader(min_interval=0, max_retries=0)
+
+    patches = [
+        mock.patch.object(draw_text_on_image, "get_format", lambda: image_format),
+        mock.patch.object(draw_text_on_image, "get_img_output_file_paths",
+                          get_img_output_file_paths),
+        mock.patch.object(draw_text_on_image, "get_manifest", get_manifest),
+        mock.patch.object(upload_to_instagram, "get_manifest", get_manifest),
+        mock.patch.object(upload_to_instagram, "get_caption_store", get_caption_store),
+        mock.patch.object(upload_to_instagram, "_uploader", uploader),
+        mock.patch.object(download_from_reddit, "initialize", lambda: reddit),
+        mock.patch.object(download_from_reddit, "sync_mirror", lambda db: None),
+        mock.patch.object(download_from_reddit, "get_near_duplicate_index",
+                          get_near_duplicate_index),
+        mock.patch.object(pipeline, "sync_mirror", lambda db: None),
+        mock.patch.object(pipeline, "get_db", lambda buffered=False: db),
+        mock.patch.object(pipeline, "FetchCheckpoints",
+                          lambda: FetchCheckpoints(work_dir + "/fetch_checkpoints.json")),
+        mock.patch.object(pipeline, "get_caption_store", get_caption_store),
+    ]
+    if fake_nlp:
+        patches += [mock.patch.object(captions, "get_hashtags_batch", fake_hashtags_batch),
+                    mock.patch.object(pipeline, "get_lemmatizer", lambda: None)]
+    with ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        draw_text_on_image.get_template.cache_clear()  # Drawn with the fonts of the real format
+        try:
+            yield
+        finally:
+            draw_text_on_image.get_template.cache_clear()
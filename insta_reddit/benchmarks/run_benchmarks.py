@@ -0,0 +1,300 @@
+"""
+Benchmark the hot paths offline, against fakes of Google Sheets, Reddit and Instagram
+Results are written as JSON with the commit they were measured at, and can be compared with an
+earlier run:
+python insta_reddit/benchmarks/run_benchmarks.py --font /path/to/font.ttf --output after.json \
+    --compare before.json
+"""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.benchmarks.bench_cleanup import make_content_df
+from insta_reddit.benchmarks.fakes import FakeBot, FakeReddit, FakeWorksheet, make_posts, \
+    offline_environment
+from insta_reddit.code.download_from_reddit import cleanup_content, get_posts_for_specs, \
+    save_posts_to_gsheets
+from insta_reddit.code.image_utils import GLYPH_CACHE, ImageText, TextLayout, get_font
+from insta_reddit.code.sheets_db import SheetsDb
+from insta_reddit.code.sqlite_db import SqliteDb
+
+BENCHMARKS = ["layout", "render", "write_on_img", "cleanup", "sheets", "fetch_store", "pipeline"]
+FONT_BENCHMARKS = ["layout", "render", "write_on_img", "pipeline"]
+SAMPLE_TITLES = [post["title"] for post in make_posts(50, seed=1)]
+NO_QUOTA = 10 ** 9  # The fake sheet has no quotas, don't wait for them
+
+
+def best_of(func, repeat=3):
+    """ Lowest wall time of a few runs of func, the least disturbed by the rest of the machine
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def bench_layout(args):
+    get_font.cache_clear()
+    results = {}
+    for font_size in [40, 60, 90]:
+        seconds = best_of(lambda: [TextLayout(title, 1200, args.font, font_size)
+                                   for title in SAMPLE_TITLES])
+        results["size_{}".format(font_size)] = {"seconds_per_layout": seconds / len(SAMPLE_TITLES)}
+    return results
+
+
+def bench_render(args):
+    results = {}
+    background = ImageText((1500, 1500), mode='RGB', background=(255, 255, 255))
+    for place, cold in [("left", False), ("justify", False), ("justify_cold", True)]:
+        def render():
+            if cold:  # Every word rasterized again, as for the first image of a run
+                GLYPH_CACHE.clear()
+            for title in SAMPLE_TITLES:
+                background.copy().write_vertically_centred_text_box(
+                    left_padding=150, upper=450, lower=1350, text=title, box_width=1200,
+                    font_filename=args.font, font_size=60, place=place.split("_")[0])
+        results[place] = {"seconds_per_image": best_of(render) / len(SAMPLE_TITLES)}
+    image = background.copy()
+    image.write_vertically_centred_text_box(left_padding=150, upper=450, lower=1350,
+                                            text=SAMPLE_TITLES[0], box_width=1200,
+                                            font_filename=args.font, font_size=60)
+    results["glyph_cache"] = GLYPH_CACHE.info()
+    results["encode_default"] = {"seconds": best_of(lambda: image.encode()),
+                                 "bytes": len(image.encode()[0])}
+    return results
+
+
+def bench_write_on_img(args):
+    from insta_reddit.code.draw_text_on_image import write_on_imgs
+    records = [dict(post, title=post["title"][:300]) for post in make_posts(args.images)]
+    work_dir = tempfile.mkdtemp()
+    try:
+        with offline_environment(work_dir, args.font, db=None):
+            start = time.perf_counter()
+            failures = write_on_imgs(records, workers=1)
+            seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir)
+    return {"images": len(records), "failures": len(failures),
+            "seconds_per_record": seconds / len(records)}
+
+
+def bench_cleanup(args):
+    results = {}
+    for size in [int(size) for size in args.cleanup_sizes.split(",")]:
+        content_df = make_content_df(size)
+        results["rows_{}".format(size)] = {
+            "seconds": best_of(lambda: cleanup_content(content_df.copy()))}
+    return results
+
+
+def bench_sheets(args):
+    posts = make_posts(args.sheet_rows + args.sheet_ops)
+    existing, new = posts[args.sheet_ops:], posts[:args.sheet_ops]
+    results = {}
+
+    def measure(name, func, worksheet):
+        worksheet.calls.clear()
+        start = time.perf_counter()
+        func()
+        results[name] = {"seconds": time.perf_counter() - start,
+                         "api_calls": sum(worksheet.calls.values()),
+                         "calls": dict(worksheet.calls)}
+
+    worksheet = FakeWorksheet.from_posts(existing, uploaded_fraction=0)
+    sdb = SheetsDb(None, worksheet=worksheet, read_quota=NO_QUOTA, write_quota=NO_QUOTA)
+    lookups = [post["id"] for post in existing[::max(1, len(existing) // args.sheet_ops)]]
+    measure("load_index", sdb.load_index, worksheet)
+    measure("get_row_for_id", lambda: [sdb.get_row_for_id(post_id) for post_id in lookups],
+            worksheet)
+    measure("append_rows", lambda: sdb.append_rows(
+        [[post["title"], post["selftext"], post["author"], post["url"], post["id"]]
+         for post in new]), worksheet)
+    measure("get_unuploaded_rows", sdb.get_unuploaded_rows, worksheet)
+
+    unbuffered, buffered = lookups[:len(lookups) // 10], lookups[len(lookups) // 10:]
+    measure("update_status_unbuffered",
+            lambda: [sdb.update_image_uploaded(post_id) for post_id in unbuffered], worksheet)
+    buffered_sdb = SheetsDb(None, buffered=True, flush_size=len(buffered) + 1,
+                            worksheet=worksheet, read_quota=NO_QUOTA, write_quota=NO_QUOTA)
+    buffered_sdb.load_index()
+
+    def update_buffered():
+        for post_id in buffered:
+            buffered_sdb.update_image_uploaded(post_id)
+        buffered_sdb.flush()
+    measure("update_status_buffered", update_buffered, worksheet)
+    return results
+
+
+def bench_fetch_store(args):
+    reddit = FakeReddit(make_posts(args.posts, repost_fraction=args.repost_fraction))
+    worksheet = FakeWorksheet()
+    sdb = SheetsDb(None, buffered=True, worksheet=worksheet, read_quota=NO_QUOTA,
+                   write_quota=NO_QUOTA)
+    work_dir = tempfile.mkdtemp()
+    try:
+        with offline_environment(work_dir, args.font, db=sdb, reddit=reddit):
+            start = time.perf_counter()
+            content_df = get_posts_for_specs([("fake", "top", "all", args.posts)])
+            fetched = time.perf_counter()
+            content_df = cleanup_content(content_df)
+            cleaned = time.perf_counter()
+            rows = save_posts_to_gsheets(content_df, sdb)
+            stored = time.perf_counter()
+    finally:
+        shutil.rmtree(work_dir)
+    return {"posts": args.posts, "cleaned": len(content_df), "stored": len(rows),
+            "fetch_seconds": fetched - start, "cleanup_seconds": cleaned - fetched,
+            "store_seconds": stored - cleaned, "reddit_requests": reddit.requests,
+            "sheets_api_calls": sum(worksheet.calls.values())}
+
+
+def bench_pipeline(args):
+    from insta_reddit.code.pipeline import Pipeline
+    reddit = FakeReddit(make_posts(args.pipeline_posts))
+    bot = FakeBot()
+    work_dir = tempfile.mkdtemp()
+    try:
+        db = SqliteDb(work_dir + "/posts.db")
+        with offline_environment(work_dir, args.font, db=db, reddit=reddit, bot=bot,
+                                 fake_nlp=args.fake_nlp):
+            pipeline = Pipeline([("fake", "top", "all", args.pipeline_posts)], post_count=None,
+                                upload_interval=0)
+            start = time.perf_counter()
+            uploaded = pipeline.run()
+            seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir)
+    return {"posts": args.pipeline_posts, "uploaded": uploaded, "seconds": seconds,
+            "posts_per_second": uploaded / seconds if seconds else None,
+            "reddit_requests": reddit.requests, "logins": bot.logins}
+
+
+def font_loads(font_filename):
+    try:
+        get_font(font_filename, 12)
+        return True
+    except OSError:
+        return False
+
+
+def nltk_data_available():
+    try:
+        from insta_reddit.code.captions import get_lemmatizer
+        get_lemmatizer()
+        return True
+    except LookupError:
+        return False
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=git_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    """ {"a": {"b": 1}} -> {"a.b": 1}, keeping only the numbers
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(previous, current):
+    """ Prints the ratio of every number measured by both runs
+    """
+    before, after = flatten(previous["results"]), flatten(current["results"])
+    print("Compared with {}:".format(previous.get("commit")))
+    for key in sorted(set(before) & set(after)):
+        if before[key]:
+            print("  {:<55} {:>12.4g} -> {:<12.4g} {:.2f}x".format(
+                key, before[key], after[key], after[key] / before[key]))
+
+
+def main(args):
+    selected = args.benchmarks.split(",") if args.benchmarks else BENCHMARKS
+    skipped = {}
+    if not font_loads(args.font):
+        for name in FONT_BENCHMARKS:
+            skipped[name] = "Font {} can't be loaded, pass one with --font".format(args.font)
+    if "pipeline" in selected and not args.fake_nlp and not nltk_data_available():
+        print("NLTK data not found, generating hashtags without it.")
+        args.fake_nlp = True
+
+    results = {}
+    for name in selected:
+        if name in skipped:
+            print("Skipping {}: {}".format(name, skipped[name]))
+            continue
+        print("Running {}...".format(name))
+        results[name] = globals()["bench_" + name](args)
+        print(json.dumps(results[name], indent=2))
+
+    report = {"commit": get_commit(),
+              "timestamp": time.time(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "options": {key: value for key, value in vars(args).items()
+                          if key not in ("output", "compare")},
+              "skipped": skipped,
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', dest='benchmarks', default=None,
+                        help="""Comma-separated benchmarks to run, out of: {}. All by default"""
+                        .format(",".join(BENCHMARKS)))
+    parser.add_argument('--font', dest='font', default="arial.ttf",
+                        help="""Font to render with, the benchmarks drawing text are skipped if
+                        it can't be loaded""")
+    parser.add_argument('--images', dest='images', default=20, type=int,
+                        help="""Number of records to generate images for in write_on_img""")
+    parser.add_argument('--cleanup_sizes', dest='cleanup_sizes', default="1000,10000,100000",
+                        help="""Comma-separated numbers of rows to clean up""")
+    parser.add_argument('--sheet_rows', dest='sheet_rows', default=10000, type=int,
+                        help="""Number of rows in the fake sheet""")
+    parser.add_argument('--sheet_ops', dest='sheet_ops', default=1000, type=int,
+                        help="""Number of lookups, appends and status updates on the fake sheet""")
+    parser.add_argument('--posts', dest='posts', default=100000, type=int,
+                        help="""Number of synthetic posts to fetch, clean up and store""")
+    parser.add_argument('--repost_fraction', dest='repost_fraction', default=0.05, type=float,
+                        help="""Share of the synthetic posts repeating an earlier one reworded, for
+                        the near-duplicate index to catch""")
+    parser.add_argument('--pipeline_posts', dest='pipeline_posts', default=200, type=int,
+                        help="""Number of synthetic posts to run through the whole pipeline.
+                        Every one of them is rendered, so keep it well below --posts""")
+    parser.add_argument('--fake_nlp', dest='fake_nlp', action='store_true',
+                        help="""Generate hashtags without NLTK, automatic if its data is missing""")
+    parser.add_argument('--output', dest='output', default=None,
+                        help="""JSON file to write the results to""")
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help="""JSON results of an earlier run to compare with""")
+    main(args=parser.parse_args())
+    sys.exit(0)
@@ -0,0 +1,143 @@
+"""
+Single entry point for every step: python -m insta_reddit <command> [options]
+Only the modules a command needs are imported, and only once it runs,
+so e.g. status never loads pandas, praw, nltk or instabot.
+"""
+import argparse
+import importlib
+import sys
+
+
+def add_fetch_arguments(parser):
+    parser.add_argument('--subreddit_name', dest='subreddit_name', default="unethicallifeprotips",
+                        help="""Name of the subreddit""")
+    parser.add_argument('--post_count', dest='post_count', default=15,
+                        help="""Number of posts to fetch""")
+    parser.add_argument('--time_filter', dest='time_filter', default="month",
+                        help="""day/month/week etc, used when sorting by top""")
+    parser.add_argument('--listing', dest='listing', default="top",
+                        help="""top/hot/new/rising/controversial""")
+    parser.add_argument('--specs', dest='specs', default=None,
+                        help="""Comma-separated subreddit:listing:time_filter:limit specs to
+                        fetch concurrently, e.g. LifeProTips:top:month:15,LifeProTips:hot::10.
+                        Overrides the subreddit_name, post_count, time_filter and listing""")
+    parser.add_argument('--workers', dest='workers', default=4,
+                        help="""Number of specs to fetch at once""")
+    parser.add_argument('--full_rescan', dest='full_rescan', action='store_true',
+                        help="""Ignore the saved checkpoints and fetch every listing in full""")
+    parser.add_argument('--fields', dest='fields', default="title,selftext,author,url,id",
+                        help="""Comma-separated list of fields to save""")
+
+
+def add_render_arguments(parser):
+    parser.add_argument('--workers', dest='workers', default=1,
+                        help="""Number of processes to render images with""")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="""Profile the rendering with cProfile and save the stats to this
+                        file, e.g. for snakeviz. Renders in a single process""")
+
+
+def add_upload_arguments(parser):
+    parser.add_argument('--post_count', dest='post_count', default=1,
+                        help="""Number of posts to post at one call""")
+    parser.add_argument('--min_interval', dest='min_interval', default=None,
+                        help="""Seconds between two uploads""")
+    parser.add_argument('--max_retries', dest='max_retries', default=3,
+                        help="""Retries of a failed upload before moving on""")
+
+
+def add_run_arguments(parser):
+    parser.add_argument('--subreddit_name', dest='subreddit_name', default="unethicallifeprotips",
+                        help="""Name of the subreddit""")
+    parser.add_argument('--fetch_count', dest='fetch_count', default=15,
+                        help="""Number of posts to fetch""")
+    parser.add_argument('--time_filter', dest='time_filter', default="month",
+                        help="""day/month/week etc, used when sorting by top""")
+    parser.add_argument('--listing', dest='listing', default="top",
+                        help="""top/hot/new/rising/controversial""")
+    parser.add_argument('--specs', dest='specs', default=None,
+                        help="""Comma-separated subreddit:listing:time_filter:limit specs,
+                        overriding the subreddit_name, fetch_count, time_filter and listing""")
+    parser.add_argument('--fields', dest='fields', default="title,selftext,author,url,id",
+                        help="""Comma-separated list of fields to save""")
+    parser.add_argument('--post_count', dest='post_count', default=1,
+                        help="""Number of posts to upload, ignored in daemon mode""")
+    parser.add_argument('--daemon', dest='daemon', action='store_true',
+                        help="""Keep running, fetching every poll_interval seconds""")
+    parser.add_argument('--poll_interval', dest='poll_interval', default=3600,
+                        help="""Seconds between two fetches in daemon mode""")
+    parser.add_argument('--upload_interval', dest='upload_interval', default=60,
+                        help="""Seconds to wait after each upload""")
+    parser.add_argument('--queue_size', dest='queue_size', default=10,
+                        help="""Posts each stage can queue up before the previous one waits""")
+    parser.add_argument('--profile_render', dest='profile_render', default=None,
+                        help="""Profile the render stage with cProfile and save the stats to
+                        this file""")
+
+
+def add_compact_arguments(parser):
+    parser.add_argument('--older_than', dest='older_than', default=30,
+                        help="""Pack the images uploaded more than this many days ago""")
+    parser.add_argument('--pack_size', dest='pack_size', default=256,
+                        help="""Size in MB from which the next images go to a new pack""")
+
+
+def add_no_arguments(parser):
+    pass
+
+
+# command: (module with a main(args), description, function adding the arguments)
+COMMANDS = {
+    "fetch": ("insta_reddit.code.download_from_reddit",
+              "Download posts from Reddit and store the new ones", add_fetch_arguments),
+    "render": ("insta_reddit.code.draw_text_on_image",
+               "Generate images for the posts yet to be uploaded", add_render_arguments),
+    "caption": ("insta_reddit.code.captions",
+                "Precompute captions for the posts yet to be uploaded", add_no_arguments),
+    "upload": ("insta_reddit.code.upload_to_instagram",
+               "Upload generated images to Instagram", add_upload_arguments),
+    "run": ("insta_reddit.code.pipeline",
+            "Run every step in a single streaming process", add_run_arguments),
+    "compact": ("insta_reddit.code.image_archive",
+                "Shard the uploaded images and pack the old ones", add_compact_arguments),
+    "status": ("insta_reddit.code.status",
+               "Show how many posts are at each step", add_no_arguments),
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="insta_reddit")
+    parser.add_argument('--metrics_json', dest='metrics_json', default=None,
+                        help="""Write a JSON summary of the run's counters and timers to this
+                        file""")
+    parser.add_argument('--prometheus_dir', dest='prometheus_dir', default=None,
+                        help="""Write the metrics to insta_reddit_<command>.prom in this folder,
+                        e.g. the directory of node exporter's textfile collector""")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    for command, (_, description, add_arguments) in COMMANDS.items():
+        add_arguments(subparsers.add_parser(command, help=description, description=description))
+    return parser
+
+
+def load_command(command):
+    """ Imports the module implementing a command
+    """
+    return importlib.import_module(COMMANDS[command][0])
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    from insta_reddit.code.metrics import METRICS
+    METRICS.configure_export(args.command, args.metrics_json, args.prometheus_dir)
+    try:
+        load_command(args.command).main(args)
+    except BaseException:
+        METRICS.export(success=False)
+        raise
+    METRICS.export()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
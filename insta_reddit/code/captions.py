@@ -0,0 +1,187 @@
+"""
+Generate captions ahead of upload
+Hashtags are memoized by a hash of the title, and every caption is stored by post ID,
+so an upload only has to read its precomputed caption.
+Run this after draw_text_on_image.py to caption every post that is yet to be uploaded.
+"""
+import hashlib
+import html
+import sqlite3
+import sys
+from functools import lru_cache
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.code.metrics import METRICS
+from insta_reddit.code.storage import get_content_folder_path, get_db, get_local_instance
+
+DEFAULT_CAPTION_PREFIX = "Unethical life pro tips be like... "
+DEFAULT_HASHTAGS = " #lifeprotips #lpt"
+MAX_NUM_HASHTAGS = 18
+
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    """
+    Returns the lemmatizer, loading WordNet, the tokenizer and the POS-tagger once per process
+    nltk itself is only imported here, so reading precomputed captions doesn't pay for it
+    """
+    """
+    # NOTE: Run the following lines from a Python console to enable hashtag generation:
+    import nltk
+    nltk.download("punkt")
+    nltk.download('averaged_perceptron_tagger')
+    nltk.download('wordnet')
+    """
+    import nltk
+    from nltk.stem import WordNetLemmatizer
+    lemmatizer = WordNetLemmatizer()
+    lemmatizer.lemmatize("tips")  # WordNet is loaded lazily on first use
+    nltk.pos_tag(nltk.word_tokenize("Warm up the tagger."))
+    return lemmatizer
+
+
+def get_hashtags_batch(texts):
+    """
+    Returns the hashtags for many texts, POS-tagging them all in one call
+    :param list texts:  Texts of the titles
+    :return:            Space separated hashtags generated for each text
+    :rtype:             list(str)
+    """
+    # TODO: Remove stopwords
+    lemmatizer = get_lemmatizer()
+    import nltk  # Already loaded by get_lemmatizer
+    hashtag_strings = []
+    for tagged in nltk.pos_tag_sents([nltk.word_tokenize(text) for text in texts]):
+        hashtags = list(dict.fromkeys([lemmatizer.lemmatize(word) for (word, pos) in tagged
+                                       if pos[0] == 'N']))  # use nouns to get hashtags
+        hashtag_string = "#" + " #".join(hashtags[:min(len(hashtags), (MAX_NUM_HASHTAGS - 4))]) \
+            if len(hashtags) > 0 \
+            else ""  # total upto 15+4 = 19 hashtags (any more and Instagram starts lowering SEO)
+        hashtag_strings.append(hashtag_string + DEFAULT_HASHTAGS)
+    return hashtag_strings
+
+
+def get_hashtags(text):
+    """
+    Returns a string of hashtags generated from the text
+    :param str text:    The text of the title
+    :return:            Space separated hashtags generated
+    :rtype:             str
+    """
+    hashtag_string = get_hashtags_batch([text])[0]
+    print("Hashtags generated: {}".format(hashtag_string))
+    return hashtag_string
+
+
+def get_caption(record, hashtags=None):
+    """
+    Return the complete caption for a post
+    :param dict record: dict containing 'title', 'author', 'url' in its keys
+    :param str hashtags: Hashtags of the title if already generated
+    :return:            caption for the post to be uploaded
+    :rtype:             str
+    """
+    hashtags = hashtags or get_hashtags(record['title'])
+    author, url = record['author'], record['url']
+    prefix_text = DEFAULT_CAPTION_PREFIX
+    if record['selftext']:
+        st = html.unescape(record['selftext'])
+        prefix_text = st
+    return prefix_text + hashtags + \
+           "  Author: u/{}  URL: {}".format(author, url)
+
+
+def get_text_hash(text):
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+class CaptionStore:
+    def __init__(self, db_path=None):
+        """
+        Open (and create if needed) the store of precomputed captions
+        :param str db_path: Path of the SQLite file, defaults to content/captions.db
+        """
+        self.db_path = db_path or get_content_folder_path() + "/content/captions.db"
+        if self.db_path != ":memory:":
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashtags ("
+                          "title_hash TEXT PRIMARY KEY, hashtags TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS captions ("
+                          "post_id TEXT PRIMARY KEY, title_hash TEXT NOT NULL, "
+                          "caption TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get_caption(self, post_id):
+        """ Returns the precomputed caption of a post, or None
+        """
+        found = self.conn.execute("SELECT caption FROM captions WHERE post_id = ?",
+                                  (post_id,)).fetchone()
+        return found[0] if found else None
+
+    def precompute(self, records):
+        """
+        Generate and store the captions of the records that don't have one yet
+        Titles already seen are not tagged again, the others are tagged in one batch
+        :param list records:    Records with 'id', 'title', 'selftext', 'author', 'url' keys
+        :return:                Captions by post ID
+        :rtype:                 dict
+        """
+        captions = {}
+        missing = []
+        for record in records:
+            caption = self.get_caption(record['id'])
+            if caption is None:
+                missing.append(record)
+            else:
+                captions[record['id']] = caption
+        if not missing:
+            return captions
+
+        title_hashes = [get_text_hash(record['title']) for record in missing]
+        known = {}
+        for title_hash in set(title_hashes):
+            found = self.conn.execute("SELECT hashtags FROM hashtags WHERE title_hash = ?",
+                                      (title_hash,)).fetchone()
+            if found:
+                known[title_hash] = found[0]
+        to_tag = {title_hash: record['title'] for title_hash, record in zip(title_hashes, missing)
+                  if title_hash not in known}
+        if to_tag:
+            with METRICS.timer("hashtags"):
+                known.update(zip(to_tag.keys(), get_hashtags_batch(list(to_tag.values()))))
+
+        rows = []
+        for title_hash, record in zip(title_hashes, missing):
+            captions[record['id']] = get_caption(record, known[title_hash])
+            rows.append((record['id'], title_hash, captions[record['id']]))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO hashtags VALUES (?, ?)",
+                                  [(title_hash, known[title_hash]) for title_hash in to_tag])
+            self.conn.executemany("INSERT OR REPLACE INTO captions VALUES (?, ?, ?)", rows)
+        METRICS.increment("captions_generated", len(missing))
+        METRICS.increment("titles_tagged", len(to_tag))
+        print("Generated {} captions, tagged {} new titles.".format(len(missing), len(to_tag)))
+        return captions
+
+    def count(self):
+        """ Number of captions stored
+        """
+        return self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+
+def get_caption_store():
+    """ Returns the caption store for this process and thread
+    """
+    return get_local_instance("captions", CaptionStore)
+
+
+def main(args=None):
+    get_caption_store().precompute(get_db().get_unuploaded_rows())
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -3,7 +3,7 @@ Download top K posts from Reddit and save them to GSheets DB if not already save
 """
 import argparse
 import sys
-import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 git_root = str(Path(__file__).parent.parent.parent.resolve())
 sys.path.append(git_root)
@@ -11,58 +11,187 @@ import html
 
 import pandas as pd
 import praw
-from insta_reddit import credentials
-from insta_reddit.code.sheets_db import SheetsDb  # To append records to sheets
+import prawcore
+from praw.models.reddit.base import RedditBase
+from insta_reddit.code.fetch_checkpoints import FetchCheckpoints
+from insta_reddit.code.metrics import METRICS
+from insta_reddit.code.near_duplicates import get_near_duplicate_index, get_signature
+from insta_reddit.code.rate_limit import RateLimiter
+from insta_reddit.code.storage import get_db, get_local_instance, sync_mirror
+
+# Reddit allows 100 requests per minute per OAuth client, keep some headroom
+REDDIT_RATE_LIMITER = RateLimiter(rate=90 / 60.0, capacity=5)
+LISTINGS_WITH_TIME_FILTER = ["top", "controversial"]
+LISTINGS_SORTED_BY_TIME = ["new"]
+LISTING_PAGE_SIZE = 100  # Posts per listing request
+
+
+class RateLimitedRequestor(prawcore.Requestor):
+    """ Requestor making every thread using the client share REDDIT_RATE_LIMITER
+    """
+    def request(self, *args, **kwargs):
+        METRICS.observe("reddit_rate_limit_wait", REDDIT_RATE_LIMITER.acquire())
+        METRICS.increment("reddit_requests")
+        with METRICS.timer("reddit_request"):
+            return super().request(*args, **kwargs)
 
 
 def initialize():
     # NOTE: Ensure the credentials.py file is present in the current directory
+    # Imported here, so importing this module works without it
+    from insta_reddit import credentials
     reddit_obj = praw.Reddit(client_id=credentials.client_id,
                              client_secret=credentials.client_secret,
                              user_agent=credentials.user_agent,
-                             username=credentials.username)
+                             username=credentials.username,
+                             requestor_class=RateLimitedRequestor)
     if not reddit_obj.read_only:  # Flag to ensure this object has been correctly configured
         raise Exception("Reddit object not configured correctly to be read_only.")
     return reddit_obj
 
 
+def get_reddit():
+    """ Returns the Reddit client of this thread, PRAW isn't thread-safe so threads can't share one
+    Their requests still share REDDIT_RATE_LIMITER
+    """
+    return get_local_instance("reddit", initialize)
+
+
 def get_posts(reddit_obj,
               subreddit_name="unethicallifeprotips",
               post_count=20,
               time_filter="month",
-              fields=None):
+              fields=None,
+              listing="top",
+              since=None,
+              seen_ids=None):
     """
     Get all the posts as a pandas dataframe
     :param reddit_obj:      Instance of PRAW API
     :param subreddit_name:  Name of the subreddit
     :param post_count:      Number of posts
-    :param time_filter:     day/month/week etc since we are sorting by top
+    :param time_filter:     day/month/week etc, used when sorting by top or controversial
     :param fields:          List of fields to return (Refer: sample_object_json.txt)
+    :param listing:         top/hot/new/rising/controversial
+    :param since:           created_utc of the newest post already fetched, if any.
+                            The new listing stops at the first post that old
+    :param seen_ids:        IDs of the posts already fetched from the listing, if any.
+                            The other listings skip them, and stop paging after a whole page of them
     :return:                Pandas DF with "count" rows and "len(kwargs)" columns
     """
-    # TODO: Add support for hot along with top
-
     if fields is None:  # To avoid passing mutable default args
         fields = ["title", "selftext", "author", "url", "id"]
     if "id" not in fields:  # To ensure the unique ID of a post is always captured
         fields.append("id")
-    content_dict = {field: [] for field in fields}  # Initializing dict
 
     # Metadata of the fields of a submission are available here:
     # https://praw.readthedocs.io/en/latest/code_overview/models/submission.html
     # PRAW uses lazy objects so that network requests to ...
     # ... Reddit's API are only issued when information is needed.
-    for submission in reddit_obj.subreddit(subreddit_name).top(limit=post_count,
-                                                               time_filter=time_filter):
-        for field in fields:
-            content_dict[field].append(getattr(submission, field))
-    return pd.DataFrame(content_dict)
+    # Reading the fields through project_submission only uses the data of the listing pages,
+    # so the number of requests depends on the pages fetched and not on the fields.
+    listing_kwargs = {"limit": post_count}
+    if listing in LISTINGS_WITH_TIME_FILTER:
+        listing_kwargs["time_filter"] = time_filter
+    rows = []
+    seen_ids = set(seen_ids or [])
+    known_in_a_row = 0
+    for submission in getattr(reddit_obj.subreddit(subreddit_name), listing)(**listing_kwargs):
+        data = vars(submission)
+        if listing in LISTINGS_SORTED_BY_TIME:
+            if since is not None and data.get("created_utc", 0) <= since:
+                break
+        elif data.get("id") in seen_ids:
+            known_in_a_row += 1
+            if known_in_a_row >= LISTING_PAGE_SIZE:
+                break
+            continue
+        else:
+            known_in_a_row = 0
+        rows.append(project_submission(submission, fields))
+    columns = list(zip(*rows)) or [[] for _ in fields]
+    return pd.DataFrame({field: column for field, column in zip(fields, columns)}, columns=fields)
+
+
+def project_submission(submission, fields):
+    """
+    Read fields off the listing data PRAW already holds for a submission, without any fetch
+    Redditors and subreddits are converted to their names, e.g. author
+    :param submission:  PRAW submission from a listing
+    :param fields:      List of fields to return
+    :return:            Tuple of the values of the fields, None for fields not in the listing
+    """
+    data = vars(submission)  # getattr would trigger a fetch of the full submission when missing
+    values = []
+    for field in fields:
+        value = data.get(field)
+        if isinstance(value, RedditBase):
+            value = str(value)
+        elif field == "author" and value is None:
+            value = "[deleted]"
+        values.append(value)
+    return tuple(values)
+
+
+def parse_specs(specs):
+    """
+    Parse fetch specs of the form subreddit:listing:time_filter:limit, separated by commas
+    e.g. "LifeProTips:top:month:15,unethicallifeprotips:hot::10"
+    :param str specs:   Comma-separated specs
+    :return:            List of (subreddit, listing, time_filter, limit)
+    :rtype:             list(tuple)
+    """
+    parsed = []
+    for spec in specs.replace(" ", "").split(","):
+        parts = spec.split(":")
+        if len(parts) != 4:
+            raise ValueError("Spec {} is not of the form subreddit:listing:time_filter:limit"
+                             .format(spec))
+        subreddit_name, listing, time_filter, limit = parts
+        parsed.append((subreddit_name, listing or "top", time_filter or "month", int(limit)))
+    return parsed
+
+
+def get_posts_for_specs(specs, fields=None, workers=4, checkpoints=None, full_rescan=False):
+    """
+    Fetch several (subreddit, listing, time_filter, limit) specs concurrently
+    Each thread has its own Reddit client, all their requests go through REDDIT_RATE_LIMITER
+    :param list specs:      List of (subreddit, listing, time_filter, limit)
+    :param fields:          List of fields to return
+    :param int workers:     Number of specs to fetch at once
+    :param checkpoints:     FetchCheckpoints to resume from and move forward, if any
+    :param full_rescan:     Fetch the listings in full, still moving the checkpoints forward
+    :return:                Pandas DF of all the posts, de-duplicated by id
+    """
+    def fetch(spec):
+        subreddit_name, listing, time_filter, limit = spec
+        spec_fields = list(fields) if fields else None
+        since, seen_ids = None, None
+        if checkpoints is not None:
+            spec_fields = spec_fields or ["title", "selftext", "author", "url", "id"]
+            if "created_utc" not in spec_fields:
+                spec_fields.append("created_utc")
+            checkpoint = checkpoints.get(subreddit_name, listing, time_filter)
+            if checkpoint and not full_rescan:
+                since, seen_ids = checkpoint["created_utc"], checkpoint.get("seen")
+        with METRICS.timer("fetch", listing=listing):
+            content_df = get_posts(get_reddit(), subreddit_name, limit, time_filter,
+                                   spec_fields, listing, since, seen_ids)
+        METRICS.increment("posts_fetched", len(content_df), listing=listing)
+        if checkpoints is not None:
+            checkpoints.update(subreddit_name, listing, time_filter, content_df)
+        return content_df
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(specs)))) as executor:
+        content_dfs = list(executor.map(fetch, specs))
+    return pd.concat(content_dfs, ignore_index=True).drop_duplicates(subset="id")
 
 
 def cleanup_content(content_df, colnames=None):
     """
     Read the dumped posts and clean up the text
     Also convert the HTML entities to characters, e.g. '&gt;' to '>'
+    Works on whole columns with pandas string methods rather than row by row
     :param content_df:  Dataframe containing columns in colnames to clean up
     :param colnames:    Which columns to clean up
     :return:
@@ -72,53 +201,120 @@ def cleanup_content(content_df, colnames=None):
     if colnames is None:
         colnames = ['title']
 
-    def cleanup_ulpt_text(text):
-        if "request" not in text.lower():
-            text = text[text.find(' '):]
-            return None if len(text) < 20 or len(text) > 500 else html.unescape(text)
-        return None  # TODO: Add support for ULPT request
+    with METRICS.timer("cleanup"):
+        cleaned_df = cleanup_columns(content_df, colnames)
+    METRICS.increment("posts_cleaned", len(cleaned_df), result="kept")
+    METRICS.increment("posts_cleaned", len(content_df) - len(cleaned_df), result="dropped")
+    return cleaned_df
 
+
+def cleanup_columns(content_df, colnames):
+    """ The work of cleanup_content, which times it
+    """
     for colname in colnames:
-        content_df[colname] = content_df.apply(lambda row: cleanup_ulpt_text(row[colname]), axis=1)
+        text = content_df[colname].astype(object).where(content_df[colname].map(type) == str)
+        # Drop the first word, e.g. "ULPT:", keeping the space before the rest of the text
+        stripped = text.str.replace(r'^[^ ]*(?= )', '', regex=True)
+        length = stripped.str.len()
+        keep = ~text.str.lower().str.contains("request", regex=False).fillna(True) & \
+            text.str.contains(' ', regex=False).fillna(False) & \
+            (length >= 20) & (length <= 500)  # TODO: Add support for ULPT request
+        stripped = stripped.where(keep)
+        has_entity = stripped.str.contains('&', regex=False).fillna(False)
+        stripped[has_entity] = stripped[has_entity].map(html.unescape)
+        content_df[colname] = stripped
     return content_df.dropna()
 
 
-def save_posts_to_gsheets(content_df):
-    # Iterate through rows of content_df. If id not in GSheet, append row.
-    credentials_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + \
-                       "/service_account.json"
-    sdb = SheetsDb(sheet_id=credentials.sheets_url,
-                   credentials_path=credentials_path)
-    for index, row in content_df.iterrows():
-        my_list = [row.title, row.selftext, row.author.name, row.url, row.id]
-        print("Trying {}".format(row.id))
-        if sdb.get_row_for_id(row.id) == -1:  # i.e. ID not found
-            sdb.append_row(my_list)
-        else:
-            print("Found at {}".format(sdb.get_row_for_id(row.id)))
+def cleanup_content_in_chunks(content_dfs, colnames=None):
+    """
+    Stream cleanup_content over chunks of posts, for inputs too large to hold in memory
+    e.g. cleanup_content_in_chunks(pd.read_csv(path, chunksize=100000))
+    :param content_dfs: Iterable of dataframes
+    :param colnames:    Which columns to clean up
+    :return:            Generator of cleaned up dataframes
+    """
+    for content_df in content_dfs:
+        yield cleanup_content(content_df, colnames)
+
+
+def save_posts_to_gsheets(content_df, sdb=None):
+    """
+    Store the posts not already in the DB
+    :param content_df:  Cleaned up posts
+    :param sdb:         DB to store them in, defaults to the one configured in credentials.py
+    :return:            The rows appended, with values in the order of POST_COLUMNS
+    :rtype:             list(list)
+    """
+    # Drop the ids already in the DB with one set difference, then append the rest in bulk
+    sdb = sdb or get_db()
+    content_df = content_df.drop_duplicates(subset="id")
+    new_ids = set(content_df.id) - sdb.get_all_ids()
+    print("Found {} of {} posts already saved.".format(len(content_df) - len(new_ids),
+                                                       len(content_df)))
+    new_df = content_df[content_df.id.isin(new_ids)]
+    new_df, index_entries = drop_near_duplicates(new_df)
+    rows = [[row.title, row.selftext, row.author, row.url, row.id]
+            for row in new_df.itertuples(index=False)]
+    with METRICS.timer("store"):
+        sdb.append_rows(rows)
+        sdb.flush()
+        sync_mirror(sdb)
+    METRICS.increment("posts_stored", len(rows))
+    if index_entries:
+        get_near_duplicate_index().add(index_entries)  # Only once the posts are safely stored
+    return rows
+
+
+def drop_near_duplicates(content_df):
+    """
+    Look the titles up in the near-duplicate index, see near_duplicates.py
+    Near-duplicates are dropped, or only reported if near_duplicates = "flag" in credentials.py
+    :param content_df:  Posts not stored yet
+    :return:            The posts to store, and the index entries to add once they are stored
+    :rtype:             tuple(pd.DataFrame, list)
+    """
+    from insta_reddit import credentials
+    action = getattr(credentials, "near_duplicates", "skip")
+    if action == "off" or content_df.empty:
+        return content_df, []
+    index = get_near_duplicate_index()
+    oldest_first = content_df.sort_values("created_utc", kind="stable") \
+        if "created_utc" in content_df else content_df  # The oldest post of a batch is the original
+    with METRICS.timer("near_duplicate_lookup"):
+        unique, duplicates = index.split(list(oldest_first.id), list(oldest_first.title))
+    METRICS.increment("posts_near_duplicate", len(duplicates), action=action)
+    for post_id, (duplicate_of, similarity) in duplicates.items():
+        print("Post {} repeats {} ({:.0%} similar), {}.".format(
+            post_id, duplicate_of, similarity, "skipping" if action == "skip" else "storing anyway"))
+    if action == "flag":
+        flagged = content_df[content_df.id.isin(duplicates)]
+        return content_df, unique + [(post_id, get_signature(title)) for post_id, title
+                                     in zip(flagged.id, flagged.title)]
+    return content_df[~content_df.id.isin(duplicates)], unique
 
 
 def main(args):
-    reddit_obj = initialize()
-    content_df = get_posts(reddit_obj,
-                           str(args.subreddit_name),
-                           int(args.post_count),
-                           str(args.time_filter),
-                           args.fields.replace(" ", "").split(","))
+    fields = args.fields.replace(" ", "").split(",")
+    if args.specs:
+        specs = parse_specs(args.specs)
+    else:
+        specs = [(str(args.subreddit_name), str(args.listing), str(args.time_filter),
+                  int(args.post_count))]
+    checkpoints = FetchCheckpoints()
+    content_df = get_posts_for_specs(specs, fields, int(args.workers), checkpoints,
+                                     args.full_rescan)
+    if content_df.empty:
+        print("No new posts.")
+        return
     cleaned_content_df = cleanup_content(content_df)
     save_posts_to_gsheets(cleaned_content_df)
+    checkpoints.save()  # Only once the posts are safely stored
 
 
 if __name__ == "__main__":
+    from insta_reddit.cli import add_fetch_arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--subreddit_name', dest='subreddit_name', default="unethicallifeprotips",
-                        help="""Name of the subreddit""")
-    parser.add_argument('--post_count', dest='post_count', default=15,
-                        help="""Number of posts to fetch""")
-    parser.add_argument('--time_filter', dest='time_filter', default="month",
-                        help="""day/month/week etc since we are sorting by top""")
-    parser.add_argument('--fields', dest='fields', default="title,selftext,author,url,id",
-                        help="""Comma-separated list of fields to save""")
-
+    add_fetch_arguments(parser)
     main(args=parser.parse_args())
     sys.exit(0)
@@ -4,16 +4,22 @@ Read CSV of posts and generate images for them
 # Download and install fonts from: https://www.cufonfonts.com/font/helvetica-neue-9
 # https://www.cufonfonts.com/font/pragmatica-extralight
 
+import argparse
 import json
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import sys
 git_root = str(Path(__file__).parent.parent.parent.resolve())
 sys.path.append(git_root)
 
-from insta_reddit import credentials
-from insta_reddit.code.image_utils import ImageText
-from insta_reddit.code.sheets_db import SheetsDb  # To read records from GSheets
+from insta_reddit.code.image_manifest import get_manifest
+from insta_reddit.code.image_utils import GLYPH_CACHE, ImageText, get_font
+from insta_reddit.code.metrics import METRICS, profiled
+from insta_reddit.code.storage import get_db  # To read records from the DB
 
 MAX_TITLE_LEN = 400
 MAX_SELFTEXT_LEN = 830
@@ -37,8 +43,9 @@ def get_title_and_self_text(record):
 
 def get_bg_img():
     """Returns a white background ImageText object
+    Drawn directly in RGB since the images are saved as JPEGs
     """
-    return ImageText((1500, 1500), background=(255, 255, 255))
+    return ImageText((1500, 1500), mode='RGB', background=(255, 255, 255))
 
 
 def get_format():
@@ -49,10 +56,33 @@ def get_format():
             'self_text_font': 'arial.ttf',
             'subreddit_color': (159, 4, 4),
             'title_color': (33, 32, 32),
-            'self_text_color': (0, 0, 0)
+            'self_text_color': (0, 0, 0),
+            'title_font_size': 60,  # 'fit' to use the largest size that fits the box
+            'self_text_font_size': 60,
+            'max_font_size': 90,  # Upper bound when fitting the font size
+            'output_profile': 'default'  # One of the JPEG image_utils.OUTPUT_PROFILES
             }
 
 
+@lru_cache(maxsize=None)
+def get_template(kind):
+    """Returns the background with the elements common to every image of a kind drawn on it
+    Rendered once per process, callers must draw on a copy()
+    :param str kind: title or self_text
+    :rtype: ImageText
+    """
+    template = get_bg_img()
+    if kind == 'title':
+        template.write_vertically_centred_text_box(left_padding=150, upper=0, lower=750,
+                                                   text="LPT:",
+                                                   box_width=1200,
+                                                   font_filename=get_format()['subreddit_font'],
+                                                   font_size=180,
+                                                   color=get_format()['subreddit_color'],
+                                                   place='center')
+    return template
+
+
 def get_img_output_file_paths(record):
     """ File paths to save the generated images to
     """
@@ -69,12 +99,7 @@ def get_img_output_file_paths(record):
 def image_generated(record):
     """ Returns True if image has already been generated or uploaded
     """
-    cur_folder_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1])
-    title_path = "".join(
-        [cur_folder_path, "/content/images/generated/title_", record['id'], ".jpg"])
-    if Path(title_path).is_file() or \
-            Path(title_path.replace("generated/title_", "uploaded/title_")).is_file():
-        return True
+    return get_manifest().has_image(record['id'], 'title')
 
 
 def write_on_img(record=None):
@@ -94,45 +119,117 @@ def write_on_img(record=None):
     """
 
     if title:
-        title_img = get_bg_img()
-        title_img.write_vertically_centred_text_box(left_padding=150, upper=0, lower=750,
-                                                    text="LPT:",
-                                                    box_width=1200,
-                                                    font_filename=get_format()['subreddit_font'],
-                                                    font_size=180,
-                                                    color=get_format()['subreddit_color'],
-                                                    place='center')
+        render_start = time.perf_counter()
+        title_img = get_template('title').copy()
         title_img.write_vertically_centred_text_box(left_padding=150, upper=450, lower=1350,
                                                     text=title,
                                                     box_width=1200,
                                                     font_filename=get_format()['title_font'],
-                                                    font_size=60, color=get_format()['title_color'],
-                                                    place='left')
+                                                    font_size=get_format()['title_font_size'],
+                                                    color=get_format()['title_color'],
+                                                    place='left',
+                                                    max_font_size=get_format()['max_font_size'])
 
-        title_img.save(title_op)
-        print("Image generated.")
+        stats = title_img.save(title_op, profile=get_format()['output_profile'])
+        record_render_metrics('title', time.perf_counter() - render_start, stats)
+        get_manifest().record_generated(record['id'], 'title', title_op)
+        print("Image generated ({} bytes, encoded in {:.0f} ms).".format(
+            stats['bytes'], stats['seconds'] * 1000))
 
     if self_text:
-        self_text_img = get_bg_img()
+        render_start = time.perf_counter()
+        self_text_img = get_template('self_text').copy()
         self_text_img.write_vertically_centred_text_box(left_padding=150, upper=300, lower=1200,
                                                         text=self_text, box_width=1200,
                                                         font_filename=get_format()[
                                                             'self_text_font'],
-                                                        font_size=60,
+                                                        font_size=get_format()[
+                                                            'self_text_font_size'],
                                                         color=get_format()['self_text_color'],
-                                                        place='left')
-        self_text_img.save(self_text_op)
+                                                        place='left',
+                                                        max_font_size=get_format()[
+                                                            'max_font_size'])
+        stats = self_text_img.save(self_text_op, profile=get_format()['output_profile'])
+        record_render_metrics('self_text', time.perf_counter() - render_start, stats)
+        get_manifest().record_generated(record['id'], 'self_text', self_text_op)
 
 
-def main():
-    credentials_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + \
-                       "/service_account.json"
-    sdb = SheetsDb(sheet_id=credentials.sheets_url,
-                   credentials_path=credentials_path)
-    unuploaded_records = sdb.get_unuploaded_rows()
-    for record in unuploaded_records:
+def record_render_metrics(kind, seconds, stats):
+    """ Time to draw and save an image, and the part of it spent encoding
+    """
+    METRICS.observe("render", seconds, kind=kind)
+    METRICS.observe("encode", stats['seconds'], kind=kind)
+    METRICS.increment("images_rendered", kind=kind)
+    METRICS.increment("bytes_encoded", stats['bytes'], kind=kind)
+
+
+def write_on_img_safely(record):
+    """ Runs write_on_img for one record, returning the error instead of raising it
+    :return: (post ID, None on success else the formatted traceback)
+    """
+    try:
         write_on_img(record)
+        return record['id'], None
+    except Exception:
+        METRICS.increment("render_failures")
+        return record['id'], traceback.format_exc()
+
+
+def start_worker():
+    """ Drops the metrics a forked worker inherits from its parent, so only its own are sent back
+    """
+    METRICS.pop()
+
+
+def write_on_img_in_worker(record):
+    """ write_on_img_safely for a worker process, also returning the metrics it recorded
+    """
+    return write_on_img_safely(record) + (METRICS.pop(),)
+
+
+def write_on_imgs(records, workers=1, profile_path=None):
+    """
+    Generates images for all the records, spread over a process pool if workers > 1
+    A failing record is reported and does not stop the rest of the batch
+    :param list records:    Records to generate images for
+    :param int workers:     Number of worker processes
+    :param profile_path:    Profile the rendering with cProfile and save the stats there.
+                            Renders in this process since cProfile can't follow the workers
+    :return:                List of (post ID, traceback) for the records that failed
+    """
+    if profile_path is not None and workers > 1:
+        print("Profiling, rendering in a single process.")
+        workers = 1
+    if workers > 1 and len(records) > 1:
+        chunksize = max(1, len(records) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as executor:
+            results = []
+            for post_id, error, recorded in executor.map(write_on_img_in_worker, records,
+                                                         chunksize=chunksize):
+                METRICS.merge(recorded)
+                results.append((post_id, error))
+    else:
+        with profiled(profile_path):
+            results = [write_on_img_safely(record) for record in records]
+    failures = [(post_id, error) for post_id, error in results if error is not None]
+    for post_id, error in failures:
+        print("Failed to generate image for ID: {}\n{}".format(post_id, error))
+    return failures
+
+
+def main(args):
+    sdb = get_db()
+    unuploaded_records = sdb.get_unuploaded_rows()
+    failures = write_on_imgs(unuploaded_records, int(args.workers), args.profile)
+    print("Generated images for {} of {} records.".format(len(unuploaded_records) - len(failures),
+                                                          len(unuploaded_records)))
+    print("Font cache: {}".format(get_font.cache_info()))
+    print("Glyph cache: {}".format(GLYPH_CACHE.info()))
 
 
 if __name__ == "__main__":
-    main()
+    from insta_reddit.cli import add_render_arguments
+    parser = argparse.ArgumentParser()
+    add_render_arguments(parser)
+    main(args=parser.parse_args())
+    sys.exit(0)
@@ -0,0 +1,68 @@
+"""
+Newest post seen per (subreddit, listing, time_filter), so fetches can stop at what is already known
+The IDs of the latest posts seen are kept too, for the listings not sorted by time like top.
+"""
+import json
+import os
+from pathlib import Path
+
+MAX_SEEN_IDS = 1000  # Per listing, more than the posts a top or hot listing gets through in a run
+
+
+def get_checkpoints_file_path():
+    cur_folder_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1])
+    return cur_folder_path + "/content/fetch_checkpoints.json"
+
+
+class FetchCheckpoints:
+    def __init__(self, file_path=None):
+        """
+        Load the checkpoints saved by the previous runs
+        :param str file_path: JSON file to keep them in, defaults to content/fetch_checkpoints.json
+        """
+        self.file_path = file_path or get_checkpoints_file_path()
+        self.checkpoints = {}
+        if os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.checkpoints = json.load(f)
+
+    @staticmethod
+    def get_key(subreddit_name, listing, time_filter):
+        return ":".join([subreddit_name.lower(), listing, time_filter])
+
+    def get(self, subreddit_name, listing, time_filter):
+        """
+        Newest post seen for the listing
+        :return: dict with created_utc, id and the seen IDs, or None if the listing was never fetched
+        """
+        return self.checkpoints.get(self.get_key(subreddit_name, listing, time_filter))
+
+    def update(self, subreddit_name, listing, time_filter, content_df):
+        """
+        Move the checkpoint forward to the newest post in content_df and add its posts to the
+        seen IDs, in memory only until save()
+        :param content_df: Posts fetched from the listing, with created_utc and id columns
+        :return: None
+        """
+        if content_df.empty:
+            return
+        newest = content_df.loc[content_df.created_utc.idxmax()]
+        key = self.get_key(subreddit_name, listing, time_filter)
+        current = self.checkpoints.get(key)
+        if current is None or newest.created_utc > current["created_utc"]:
+            current = dict(current or {}, created_utc=float(newest.created_utc), id=str(newest.id))
+        seen = list(dict.fromkeys(current.get("seen", []) + [str(post_id)
+                                                             for post_id in content_df.id]))
+        current["seen"] = seen[-MAX_SEEN_IDS:]  # The latest ones
+        self.checkpoints[key] = current
+
+    def save(self):
+        """
+        Write the checkpoints to disk, atomically so a crash can't leave a truncated file
+        :return: None
+        """
+        Path(self.file_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.checkpoints, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.file_path)
@@ -0,0 +1,128 @@
+"""
+Keep the number of files and the size of the folders of uploaded images bounded
+Uploaded images not in their shard of content/images/uploaded yet are moved there, then the ones
+uploaded more than older_than days ago are packed into tar files in content/images/packs.
+The manifest keeps where each image starts in its pack, so ImageManifest.read_image reads it
+back by post ID without unpacking, and any tar tool can still extract them.
+python -m insta_reddit compact --older_than 30
+"""
+import argparse
+import os
+import sys
+import tarfile
+import time
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.code.image_manifest import get_images_folder_path, get_manifest, \
+    get_pack_index, get_shard
+from insta_reddit.code.metrics import METRICS
+
+DEFAULT_OLDER_THAN = 30  # Days since the upload before an image is packed
+DEFAULT_PACK_SIZE = 256  # MB from which the next images go to a new pack
+
+
+def reshard(manifest=None):
+    """
+    Move the loose uploaded images to their shard, e.g. the ones uploaded before sharding
+    :param ImageManifest manifest: Defaults to the manifest of this process
+    :return int: Number of images moved
+    """
+    manifest = manifest or get_manifest()
+    moved = 0
+    for image in manifest.get_loose_uploaded_images():
+        in_shard = os.path.basename(os.path.dirname(image["path"])) == get_shard(image["post_id"])
+        if not in_shard and os.path.isfile(image["path"]):
+            manifest.move_to_uploaded(image["path"])
+            moved += 1
+    return moved
+
+
+def get_next_pack_path(packs_folder):
+    numbers = [int(path.stem[len("pack_"):]) for path in Path(packs_folder).glob("pack_*.tar")
+               if path.stem[len("pack_"):].isdigit()]
+    return os.path.join(packs_folder, "pack_{:06d}.tar".format(max(numbers, default=0) + 1))
+
+
+def write_pack(manifest, packs_folder, images):
+    """
+    Write images to a new pack, point the manifest to it, then delete their files
+    The pack only gets its name once complete, so a crash before that leaves the images as they were
+    :param ImageManifest manifest:  Manifest the images are recorded in
+    :param str packs_folder:        Folder of the packs
+    :param list images:             Rows of the manifest of the images to pack
+    :return str: Path of the pack
+    """
+    pack_path = get_next_pack_path(packs_folder)
+    temp_path = pack_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        with tarfile.open(fileobj=f, mode="w") as tar:
+            for image in images:
+                tar.add(image["path"], arcname=os.path.basename(image["path"]))
+        f.flush()
+        os.fsync(f.fileno())  # The files are deleted next, the pack has to be on disk by then
+    index = get_pack_index(temp_path)
+    os.replace(temp_path, pack_path)
+    manifest.record_packed(pack_path, [
+        (image["post_id"], image["kind"]) + index[os.path.basename(image["path"])]
+        for image in images])
+    for image in images:
+        os.remove(image["path"])
+    METRICS.increment("images_packed", len(images))
+    print("Packed {} images into {} ({:.1f} MB).".format(
+        len(images), pack_path, os.path.getsize(pack_path) / 1024 / 1024))
+    return pack_path
+
+
+def compact(manifest=None, older_than=DEFAULT_OLDER_THAN, pack_size=DEFAULT_PACK_SIZE,
+            images_folder_path=None):
+    """
+    Pack the loose uploaded images older than older_than days, the oldest first
+    :param ImageManifest manifest:  Defaults to the manifest of this process
+    :param float older_than:        Days since the upload, from the modification time of the file
+    :param float pack_size:         MB from which the next images go to a new pack
+    :param str images_folder_path:  Folder containing packs/, defaults to content/images
+    :return: Number of images packed, and the paths of the packs written
+    :rtype: tuple(int, list)
+    """
+    manifest = manifest or get_manifest()
+    packs_folder = os.path.join(images_folder_path or get_images_folder_path(), "packs")
+    cutoff = time.time() - older_than * 24 * 3600
+    images = []
+    for image in manifest.get_loose_uploaded_images():
+        try:
+            stat = os.stat(image["path"])
+        except FileNotFoundError:
+            print("Image file not found: {}".format(image["path"]))
+            continue
+        if stat.st_mtime < cutoff:
+            images.append((stat.st_mtime, stat.st_size, image))
+    images.sort(key=lambda found: found[0])
+
+    batches, batch_size = [], 0
+    for _, file_size, image in images:
+        if not batches or batch_size + file_size > pack_size * 1024 * 1024:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(image)
+        batch_size += file_size
+    Path(packs_folder).mkdir(parents=True, exist_ok=True)
+    pack_paths = [write_pack(manifest, packs_folder, batch) for batch in batches]
+    return len(images), pack_paths
+
+
+def main(args):
+    manifest = get_manifest()
+    print("Moved {} uploaded images to their shard.".format(reshard(manifest)))
+    packed, pack_paths = compact(manifest, float(args.older_than), float(args.pack_size))
+    print("Packed {} images into {} new packs, {} packed in total.".format(
+        packed, len(pack_paths), manifest.get_packed_count()))
+
+
+if __name__ == "__main__":
+    from insta_reddit.cli import add_compact_arguments
+    parser = argparse.ArgumentParser()
+    add_compact_arguments(parser)
+    main(args=parser.parse_args())
+    sys.exit(0)
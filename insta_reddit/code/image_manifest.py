@@ -0,0 +1,257 @@
+"""
+Manifest of every rendered image, so lookups don't have to probe or glob the image folders
+Uploaded images are sharded into content/images/uploaded/<shard>/, and the old ones can be packed
+into content/images/packs by image_archive.py, the manifest keeping where each one is in its pack.
+Run with --reconcile to rebuild it from the files in content/images/generated, uploaded and packs.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.code.storage import get_content_folder_path, get_local_instance
+
+IMAGE_KINDS = ["title", "self_text"]  # File names are <kind>_<post ID>.jpg
+# Reddit IDs are sequential in base 36, so their last characters are the ones spreading the images
+# evenly: 36 ** 2 shards of uploaded images
+SHARD_LENGTH = 2
+
+
+def get_images_folder_path():
+    return get_content_folder_path() + "/content/images"
+
+
+def get_file_hash(file_path):
+    """ SHA-256 of the contents of a file
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_image_file_name(file_name):
+    """
+    Returns the kind and post ID of an image file name, e.g. ("self_text", "abc123")
+    :rtype: tuple(str, str), or (None, None) if it is not an image of ours
+    """
+    stem, ext = os.path.splitext(file_name)
+    if ext.lower() != ".jpg":
+        return None, None
+    for kind in sorted(IMAGE_KINDS, key=len, reverse=True):  # self_text before title
+        if stem.startswith(kind + "_"):
+            return kind, stem[len(kind) + 1:]
+    return None, None
+
+
+def get_shard(post_id):
+    """ Name of the folder an uploaded image of the post goes to
+    """
+    return str(post_id)[-SHARD_LENGTH:].rjust(SHARD_LENGTH, "0")
+
+
+def get_pack_index(pack_path):
+    """
+    Where the images of a pack start, read from its tar headers
+    :param str pack_path: Path of the tar file
+    :return: {file name: (offset, size)}
+    :rtype: dict
+    """
+    with tarfile.open(pack_path) as tar:
+        return {member.name: (member.offset_data, member.size) for member in tar if member.isfile()}
+
+
+class ImageManifest:
+    def __init__(self, db_path=None):
+        """
+        Open (and create if needed) the manifest
+        :param str db_path: Path of the SQLite file, defaults to content/images/manifest.db
+        """
+        self.db_path = db_path or get_images_folder_path() + "/manifest.db"
+        if self.db_path != ":memory:":
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        # Several render workers may write at once, so wait on the lock instead of failing
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("CREATE TABLE IF NOT EXISTS images ("
+                          "post_id TEXT NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, "
+                          "sha256 TEXT, state TEXT NOT NULL, "
+                          "PRIMARY KEY (post_id, kind))")
+        # Images packed by image_archive.py, whose path is their pack
+        self.conn.execute("CREATE TABLE IF NOT EXISTS packed_images ("
+                          "post_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                          "data_offset INTEGER NOT NULL, data_size INTEGER NOT NULL, "
+                          "PRIMARY KEY (post_id, kind))")
+        self.conn.commit()
+
+    def record_generated(self, post_id, kind, path):
+        """
+        Record a freshly rendered image
+        :param str post_id: Reddit post ID
+        :param str kind:    title or self_text
+        :param str path:    Where the image was saved
+        :return: None
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, 'generated')",
+                              (post_id, kind, path, get_file_hash(path)))
+
+    def get_images(self, post_id, kind=None, state=None):
+        """
+        Images recorded for a post, in the order of IMAGE_KINDS
+        :param str post_id: Reddit post ID
+        :param str kind:    Only return this kind if given
+        :param str state:   Only return images in this state (generated/uploaded) if given
+        :rtype: list(dict), with data_offset and data_size set if the image is packed
+        """
+        rows = [dict(row) for row in
+                self.conn.execute("SELECT * FROM images LEFT JOIN packed_images "
+                                  "USING (post_id, kind) WHERE post_id = ?", (post_id,))
+                if (kind is None or row["kind"] == kind) and
+                (state is None or row["state"] == state)]
+        return sorted(rows, key=lambda row: IMAGE_KINDS.index(row["kind"]))
+
+    def has_image(self, post_id, kind="title"):
+        """ Whether an image of the kind has been generated or uploaded for the post
+        """
+        return self.conn.execute("SELECT 1 FROM images WHERE post_id = ? AND kind = ?",
+                                 (post_id, kind)).fetchone() is not None
+
+    def get_counts(self):
+        """ Number of images by state, e.g. {"generated": 3, "uploaded": 120}
+        """
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state"))
+
+    def get_packed_count(self):
+        """ Number of uploaded images packed
+        """
+        return self.conn.execute("SELECT COUNT(*) FROM packed_images").fetchone()[0]
+
+    def read_image(self, post_id, kind="title"):
+        """
+        Contents of an image, whether it is a file of its own or packed
+        :param str post_id: Reddit post ID
+        :param str kind:    title or self_text
+        :return bytes: The image file, or None if there is no such image
+        """
+        found = self.get_images(post_id, kind)
+        if not found:
+            return None
+        with open(found[0]["path"], "rb") as f:
+            if found[0]["data_offset"] is None:
+                return f.read()
+            f.seek(found[0]["data_offset"])
+            return f.read(found[0]["data_size"])
+
+    def get_loose_uploaded_images(self):
+        """ Uploaded images not packed yet
+        :rtype: list(dict)
+        """
+        return [dict(row) for row in self.conn.execute(
+            "SELECT * FROM images LEFT JOIN packed_images USING (post_id, kind) "
+            "WHERE state = 'uploaded' AND data_offset IS NULL")]
+
+    def record_packed(self, pack_path, entries):
+        """
+        Point images to the pack they were written to, all at once
+        :param str pack_path:   Path of the pack
+        :param list entries:    (post ID, kind, offset, size) of each image in the pack
+        :return: None
+        """
+        with self.conn:
+            self.conn.executemany("UPDATE images SET path = ? WHERE post_id = ? AND kind = ?",
+                                  [(pack_path, post_id, kind) for post_id, kind, _, _ in entries])
+            self.conn.executemany("INSERT OR REPLACE INTO packed_images VALUES (?, ?, ?, ?)",
+                                  entries)
+
+    def move_to_uploaded(self, file_path):
+        """
+        Move a generated image to its shard of the uploaded folder and record it in the same
+        transaction. If the move fails the manifest is left untouched
+        :param str file_path: Path of the generated image, or of an uploaded one not in its shard
+        :return str: The new path of the image
+        """
+        folder, file_name = os.path.split(file_path)
+        kind, post_id = parse_image_file_name(file_name)
+        generated = os.path.basename(folder) == "generated"
+        if generated:
+            folder = os.path.join(os.path.dirname(folder), "uploaded")
+        if kind is not None:
+            if os.path.basename(folder) == get_shard(post_id):
+                folder = os.path.dirname(folder)
+            folder = os.path.join(folder, get_shard(post_id))
+        new_path = os.path.join(folder, file_name)
+        with self.conn:
+            if kind is not None:
+                found = self.conn.execute("SELECT sha256 FROM images WHERE post_id = ? AND kind = ?",
+                                          (post_id, kind)).fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, 'uploaded')",
+                                  (post_id, kind, new_path, found[0] if found else None))
+            Path(new_path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(file_path, new_path)
+        if generated:
+            os.utime(new_path)  # The modification time tells image_archive.py when it was uploaded
+        return new_path
+
+    def reconcile(self, images_folder_path=None):
+        """
+        Rebuild the manifest from the images on disk
+        :param str images_folder_path: Folder containing generated/, uploaded/ and packs/
+        :return int: Number of images recorded
+        """
+        images_folder_path = images_folder_path or get_images_folder_path()
+        rows, packed = [], []
+        # Later ones win if an image is in several places: uploaded over generated, a loose
+        # uploaded image over a packed one, since it is only deleted once packed
+        packs_folder = os.path.join(images_folder_path, "packs")
+        if os.path.isdir(packs_folder):
+            for pack_path in sorted(str(path) for path in Path(packs_folder).glob("*.tar")):
+                with open(pack_path, "rb") as f:
+                    for file_name, (offset, size) in get_pack_index(pack_path).items():
+                        kind, post_id = parse_image_file_name(file_name)
+                        if kind is None:
+                            continue
+                        f.seek(offset)
+                        rows.append((post_id, kind, pack_path,
+                                     hashlib.sha256(f.read(size)).hexdigest(), "uploaded"))
+                        packed.append((pack_path, (post_id, kind, offset, size)))
+        for state in ["generated", "uploaded"]:
+            folder = os.path.join(images_folder_path, state)
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                entries = os.scandir(entry.path) if entry.is_dir() else [entry]  # Shards
+                for image_entry in entries:
+                    kind, post_id = parse_image_file_name(image_entry.name)
+                    if kind is not None and image_entry.is_file():
+                        rows.append((post_id, kind, image_entry.path,
+                                     get_file_hash(image_entry.path), state))
+        paths = {(post_id, kind): path for post_id, kind, path, _, _ in rows}
+        with self.conn:
+            self.conn.execute("DELETE FROM images")
+            self.conn.execute("DELETE FROM packed_images")
+            self.conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("INSERT OR REPLACE INTO packed_images VALUES (?, ?, ?, ?)",
+                                  [entry for pack_path, entry in packed
+                                   if paths[entry[:2]] == pack_path])
+        return len(paths)
+
+
+def get_manifest():
+    """ Returns the manifest for this process and thread
+    """
+    return get_local_instance("image_manifest", ImageManifest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reconcile', dest='reconcile', action='store_true',
+                        help="""Rebuild the manifest from the images on disk""")
+    args = parser.parse_args()
+    if args.reconcile:
+        print("{} images recorded.".format(get_manifest().reconcile()))
+    sys.exit(0)
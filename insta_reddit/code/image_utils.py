@@ -1,8 +1,200 @@
 # Surya's modification of Alvaro Justen's gist - with due permissions:
 # https://gist.github.com/turicas/1455973/8ca2c5fc823b611ea1a0f631fe2fbfef4c9591d7
 
+import io
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
 from PIL import Image, ImageDraw, ImageFont
 
+FONT_CACHE_SIZE = 64
+GLYPH_CACHE_BYTES = 32 * 1024 * 1024  # Budget of the rasterized words and lines kept around
+SUBPIXEL_STEPS = 4  # Fractional positions are rounded to 1/4 px so the masks can be reused
+
+# (file format, encoder settings passed on to PIL) when saving, see ImageText.save
+# A profile can only be used for its format, None for any
+# https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html
+OUTPUT_PROFILES = {
+    'default': (None, {}),  # PIL defaults
+    'jpeg_small': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True,
+                            'subsampling': '4:2:0'}),
+    'jpeg_high': ('JPEG', {'quality': 95, 'optimize': True, 'subsampling': '4:4:4'}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'webp_lossless': ('WEBP', {'lossless': True, 'method': 6}),
+}
+FILE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(font_filename, font_size):
+    """
+    Returns the parsed font, cached per process so a font file is read once per size
+    Hit/miss counters are available through get_font.cache_info()
+    """
+    return ImageFont.truetype(font_filename, font_size)
+
+
+class GlyphCache(object):
+    """
+    Rasterized runs of text (a word or a line) as masks, keyed by font, size, text and subpixel
+    offset, so common words are rendered once and then pasted in any color
+    The least recently used masks are evicted once they take more than max_bytes.
+    """
+    def __init__(self, max_bytes=GLYPH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.masks = OrderedDict()  # key: (mask, (x, y) of the mask from the text position)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_mask(self, font_filename, font_size, text, start):
+        """
+        :param start:   Fractional part of the (x, y) the text is drawn at, already rounded
+        :return:        (mask, offset) where the mask goes at the integer position plus offset
+        """
+        key = (font_filename, font_size, text, start)
+        with self.lock:
+            found = self.masks.get(key)
+            if found is not None:
+                self.masks.move_to_end(key)
+                self.hits += 1
+                return found
+            self.misses += 1
+        found = self.render(get_font(font_filename, font_size), text, start)
+        with self.lock:
+            self.masks[key] = found
+            self.bytes += found[0].width * found[0].height
+            while self.bytes > self.max_bytes and len(self.masks) > 1:
+                mask, _ = self.masks.popitem(last=False)[1]
+                self.bytes -= mask.width * mask.height
+                self.evictions += 1
+        return found
+
+    @staticmethod
+    def render(font, text, start):
+        """ Rasterize the text the way ImageDraw.text does, as an 'L' image of its coverage
+        """
+        mask, offset = font.getmask2(text, 'L', start=start)
+        return Image.Image()._new(mask), offset  # getmask2 returns Pillow's internal image
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'masks': len(self.masks), 'bytes': self.bytes}
+
+    def clear(self):
+        with self.lock:
+            self.masks.clear()
+            self.bytes = 0
+
+
+GLYPH_CACHE = GlyphCache()
+
+
+def split_position(value):
+    """ Integer pixel and fractional offset rounded to 1 / SUBPIXEL_STEPS of a coordinate
+    """
+    pixel = math.floor(value)
+    fraction = round((value - pixel) * SUBPIXEL_STEPS) / SUBPIXEL_STEPS
+    if fraction >= 1:
+        return pixel + 1, 0.0
+    return pixel, fraction
+
+
+class TextLayout(object):
+    """
+    Text wrapped into a box of a given width, ready to be drawn any number of times
+    Lines break where measuring the whole line word after word would break them, but the number
+    of words of a line is first estimated from the widths of its words, so a line usually takes
+    two measurements instead of one per word.
+    """
+    def __init__(self, text, box_width, font_filename, font_size):
+        self.box_width = box_width
+        self.font_filename = font_filename
+        self.font_size = font_size
+        font = get_font(font_filename, font_size)
+        space_width = font.getsize(' ')[0]
+        words = text.split()
+        word_widths = {}
+        for word in words:
+            if word not in word_widths:
+                word_widths[word] = font.getsize(word)[0]
+
+        self.lines = []  # list of (words, word widths, line width)
+        start = 0
+        while start < len(words):
+            line_widths = {}
+
+            def get_line_width(count):
+                if count not in line_widths:
+                    line_widths[count] = font.getsize(' '.join(words[start:start + count]))[0]
+                return line_widths[count]
+
+            count, estimate = 1, word_widths[words[start]]
+            while start + count < len(words) and \
+                    estimate + space_width + word_widths[words[start + count]] <= box_width:
+                estimate += space_width + word_widths[words[start + count]]
+                count += 1
+            while count > 1 and get_line_width(count) > box_width:
+                count -= 1
+            while start + count < len(words) and get_line_width(count + 1) <= box_width:
+                count += 1
+            line_words = words[start:start + count]
+            self.lines.append((line_words, [word_widths[word] for word in line_words],
+                               get_line_width(count)))
+            start += count
+
+        # Like the line by line measurement did, the line height is the height of the last line
+        # tried, i.e. the last line, or the one before it plus the last word if that one is alone
+        last_tried = []
+        if self.lines:
+            last_tried = self.lines[-1][0]
+            if len(last_tried) == 1 and len(self.lines) > 1:
+                last_tried = self.lines[-2][0] + last_tried
+        self.line_height = font.getsize(' '.join(last_tried))[1] if last_tried else 0
+        self.height = len(self.lines) * self.line_height
+        self.width = max([line[2] for line in self.lines] or [0])
+
+    def fits(self, max_height):
+        """ Whether the wrapped text fits within the box width and max_height
+        """
+        return self.width <= self.box_width and self.height <= max_height
+
+    def get_draw_ops(self, xy, place='left', justify_last_line=False):
+        """
+        Positions of the text to draw for the layout placed at xy
+        :param xy:                  (x, y) of the top left corner of the textbox
+        :param place:               Text alignment: left, right, center, justify.
+        :param justify_last_line:   Whether to justify the last line
+        :return:                    List of ((x, y), text)
+        """
+        x, y = xy
+        ops = []
+        for index, (words, widths, line_width) in enumerate(self.lines):
+            height = y + index * self.line_height
+            if place == 'right':
+                ops.append(((x + self.box_width - line_width, height), ' '.join(words)))
+            elif place == 'center':
+                ops.append(((int(x + ((self.box_width - line_width) / 2)), height),
+                            ' '.join(words)))
+            elif place == 'justify' and len(words) > 1 and \
+                    (index < len(self.lines) - 1 or justify_last_line):
+                words_width = get_font(self.font_filename, self.font_size).getsize(
+                    ''.join(words))[0]
+                space_width = (self.box_width - words_width) / (len(words) - 1.0)
+                start_x = x
+                for word, word_width in zip(words[:-1], widths[:-1]):
+                    ops.append(((start_x, height), word))
+                    start_x += word_width + space_width
+                ops.append(((x + self.box_width - widths[-1], height), words[-1]))
+            else:  # left, and the unjustified lines of justify
+                ops.append(((x, height), ' '.join(words)))
+        return ops
+
 
 class ImageText(object):
     def __init__(self, filename_or_size, mode='RGBA', background=(0, 0, 0, 0),
@@ -15,32 +207,109 @@ class ImageText(object):
             self.size = filename_or_size
             self.image = Image.new(mode, self.size, color=background)
             self.filename = None
+        elif isinstance(filename_or_size, Image.Image):
+            self.image = filename_or_size
+            self.size = self.image.size
+            self.filename = None
         self.draw = ImageDraw.Draw(self.image)
         self.encoding = encoding
 
-    def save(self, filename=None):
-        if filename.lower().endswith("jpg"):
-            self.image.convert('RGB').save(filename or self.filename)
-        elif filename.lower().endswith("png"):
-            self.image.save(filename or self.filename)
-        else:
+    def copy(self):
+        """ Returns a new ImageText drawing on a copy of this image, e.g. of a template
+        """
+        return ImageText(self.image.copy(), encoding=self.encoding)
+
+    def save(self, filename=None, profile='default'):
+        """
+        Save the image, with the format chosen from the file extension
+        :param filename:    Where to save, defaults to the file the image was opened from
+        :param profile:     Name of an OUTPUT_PROFILES entry, or a dict of PIL encoder options
+        :return:            dict with the bytes written and the encode time in seconds
+        """
+        filename = filename or self.filename
+        file_format = FILE_FORMATS.get(filename.lower().rsplit('.', 1)[-1])
+        if file_format is None:
             raise Exception("Unknown file format")
+        data, stats = self.encode(file_format, profile)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return stats
+
+    def encode(self, file_format='JPEG', profile='default'):
+        """
+        Encode the image into an in-memory buffer
+        :param file_format: JPEG, PNG or WEBP
+        :param profile:     Name of an OUTPUT_PROFILES entry, or a dict of PIL encoder options
+        :return:            (encoded bytes, dict with the bytes written and the encode time)
+        """
+        if isinstance(profile, str):
+            profile_format, options = OUTPUT_PROFILES[profile]
+            if profile_format not in (None, file_format):
+                raise ValueError("Output profile {} is for {} images, not {}".format(
+                    profile, profile_format, file_format))
+        else:
+            options = profile
+        image = self.image
+        if file_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        image.save(buffer, format=file_format, **options)
+        data = buffer.getvalue()
+        return data, {'bytes': len(data), 'seconds': time.perf_counter() - start}
 
     def get_font_size(self, text, font, max_width=None, max_height=None):
         if max_width is None and max_height is None:
             raise ValueError('You need to pass max_width or max_height')
-        font_size = 1
-        text_size = self.get_text_size(font, font_size, text)
+
+        def too_big(size):
+            text_size = self.get_text_size(font, size, text)
+            return (max_width is not None and text_size[0] >= max_width) or \
+                   (max_height is not None and text_size[1] >= max_height)
+
+        text_size = self.get_text_size(font, 1, text)
         if (max_width is not None and text_size[0] > max_width) or \
                 (max_height is not None and text_size[1] > max_height):
             raise ValueError("Text can't be filled in only (%dpx, %dpx)" %
                              text_size)
-        while True:
-            if (max_width is not None and text_size[0] >= max_width) or \
-                    (max_height is not None and text_size[1] >= max_height):
-                return font_size - 1
-            font_size += 1
-            text_size = self.get_text_size(font, font_size, text)
+        # Double the size until the text gets too big, then binary search for the largest fit
+        low, high = 0, 1
+        while not too_big(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            mid = (low + high) // 2
+            if too_big(mid):
+                high = mid
+            else:
+                low = mid
+        return low
+
+    @staticmethod
+    def fit_text_layout(text, box_width, max_height, font_filename, min_font_size=1,
+                        max_font_size=200):
+        """
+        Binary search for the largest font size at which the wrapped text fits the box
+        :param text:            Text to write on the image
+        :param box_width:       How wide the textbox will be
+        :param max_height:      How tall the textbox can be
+        :param font_filename:   Font file name with .ttf suffix
+        :param min_font_size:   Smallest font size to consider
+        :param max_font_size:   Largest font size to consider
+        :rtype:                 TextLayout
+        """
+        best = TextLayout(text, box_width, font_filename, min_font_size)
+        if not best.fits(max_height):
+            raise ValueError("Text can't be fit in (%dpx, %dpx) even at size %d" %
+                             (box_width, max_height, min_font_size))
+        low, high = min_font_size, max_font_size + 1  # low always fits, high never does
+        while high - low > 1:
+            mid = (low + high) // 2
+            layout = TextLayout(text, box_width, font_filename, mid)
+            if layout.fits(max_height):
+                low, best = mid, layout
+            else:
+                high = mid
+        return best
 
     def write_text(self, xy, text, font_filename, font_size=11,
                    color=(0, 0, 0), max_width=None, max_height=None):
@@ -52,7 +321,7 @@ class ImageText(object):
             font_size = self.get_font_size(text, font_filename, max_width,
                                            max_height)
         text_size = self.get_text_size(font_filename, font_size, text)
-        font = ImageFont.truetype(font_filename, font_size)
+        font = get_font(font_filename, font_size)
         if x == 'center':
             x = (self.size[0] - text_size[0]) / 2
         if y == 'center':
@@ -62,73 +331,56 @@ class ImageText(object):
 
     @staticmethod
     def get_text_size(font_filename, font_size, text):
-        font = ImageFont.truetype(font_filename, font_size)
+        font = get_font(font_filename, font_size)
         return font.getsize(text)
 
+    @staticmethod
+    def layout_text(text, box_width, font_filename, font_size=11):
+        """
+        Wrap the text into lines that fit within box_width
+        :rtype: TextLayout
+        """
+        return TextLayout(text, box_width, font_filename, font_size)
+
+    def draw_layout(self, layout, xy, color=(0, 0, 0), place='left', justify_last_line=False):
+        """
+        Draw an already computed TextLayout with its top left corner at xy
+        :return: Dimensions of the textbox (width, height)
+        """
+        for op_xy, op_text in layout.get_draw_ops(xy, place, justify_last_line):
+            self.paste_text(op_xy, op_text, layout.font_filename, layout.font_size, color)
+        return layout.box_width, layout.height
+
+    def paste_text(self, xy, text, font_filename, font_size, color=(0, 0, 0)):
+        """
+        Draw a run of text without line breaks, pasting its mask from GLYPH_CACHE in the color
+        Gives the same pixels as self.draw.text, bar positions rounded to 1 / SUBPIXEL_STEPS px
+        """
+        if self.image.mode not in ('RGB', 'RGBA', 'L'):
+            self.draw.text(xy, text, font=get_font(font_filename, font_size), fill=color)
+            return
+        x, start_x = split_position(xy[0])
+        y, start_y = split_position(xy[1])
+        mask, (offset_x, offset_y) = GLYPH_CACHE.get_mask(font_filename, font_size, text,
+                                                         (start_x, start_y))
+        self.image.paste(color, (x + offset_x, y + offset_y), mask)
+
     def write_text_box(self, xy, text, box_width, font_filename,
                        font_size=11, color=(0, 0, 0), place='left',
-                       justify_last_line=False):
-        x, y = xy
-        lines = []
-        line = []
-        words = text.split()
-        for word in words:
-            new_line = ' '.join(line + [word])
-            size = self.get_text_size(font_filename, font_size, new_line)
-            text_height = size[1]
-            if size[0] <= box_width:
-                line.append(word)
-            else:
-                lines.append(line)
-                line = [word]
-        if line:
-            lines.append(line)
-        lines = [' '.join(line) for line in lines if line]
-        height = y
-        for index, line in enumerate(lines):
-            if place == 'left':
-                self.write_text((x, height), line, font_filename, font_size,
-                                color)
-            elif place == 'right':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = x + box_width - total_size[0]
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            elif place == 'center':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = int(x + ((box_width - total_size[0]) / 2))
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            elif place == 'justify':
-                words = line.split()
-                if (index == len(lines) - 1 and not justify_last_line) or \
-                        len(words) == 1:
-                    self.write_text((x, height), line, font_filename, font_size,
-                                    color)
-                    continue
-                line_without_spaces = ''.join(words)
-                total_size = self.get_text_size(font_filename, font_size,
-                                                line_without_spaces)
-                space_width = (box_width - total_size[0]) / (len(words) - 1.0)
-                start_x = x
-                for word in words[:-1]:
-                    self.write_text((start_x, height), word, font_filename,
-                                    font_size, color)
-                    word_size = self.get_text_size(font_filename, font_size,
-                                                   word)
-                    start_x += word_size[0] + space_width
-                last_word_size = self.get_text_size(font_filename, font_size,
-                                                    words[-1])
-                last_word_x = x + box_width - last_word_size[0]
-                self.write_text((last_word_x, height), words[-1], font_filename,
-                                font_size, color)
-            height += text_height
-        return box_width, height - y
+                       justify_last_line=False, max_height=None, max_font_size=200):
+        if font_size == 'fit':
+            if max_height is None:
+                raise ValueError('You need to pass max_height to fit the text')
+            layout = self.fit_text_layout(text, box_width, max_height, font_filename,
+                                          max_font_size=max_font_size)
+        else:
+            layout = self.layout_text(text, box_width, font_filename, font_size)
+        return self.draw_layout(layout, xy, color, place, justify_last_line)
 
     def write_vertically_centred_text_box(self, left_padding, upper, lower, text, box_width,
                                           font_filename,
                                           font_size=11, color=(0, 0, 0), place='left',
-                                          justify_last_line=False):
+                                          justify_last_line=False, max_font_size=200):
         """
         Create a textbox which is vertically centred within the limits of a container in the image
         :param left_padding:        Pixels to leave on the left side before textbox begins
@@ -137,72 +389,19 @@ class ImageText(object):
         :param text:                Text to write on the image
         :param box_width:           How wide the textbox will be
         :param font_filename:       Font file name with .ttf suffix
-        :param font_size:           Size of the font
+        :param font_size:           Size of the font, or 'fit' for the largest size that fits
+                                    within box_width and the upper/lower container
         :param color:               Color of the font
         :param place:               Text alignment: left, write, center, justify.
         :param justify_last_line:   Whether to justify the last line
+        :param max_font_size:       Largest size to consider when font_size is 'fit'
         :return:                    Dimensions of the textbox (width, height)
         """
-        x = left_padding
-        lines = []
-        line = []
-        words = text.split()
-        for word in words:
-            new_line = ' '.join(line + [word])
-            size = self.get_text_size(font_filename, font_size, new_line)
-            text_height = size[1]
-            if size[0] <= box_width:
-                line.append(word)
-            else:
-                lines.append(line)
-                line = [word]
-        if line:
-            lines.append(line)
-        lines = [' '.join(line) for line in lines if line]
-
-        # Calculate y here
-        height_of_text = len(lines) * text_height
+        if font_size == 'fit':
+            layout = self.fit_text_layout(text, box_width, lower - upper, font_filename,
+                                          max_font_size=max_font_size)
+        else:
+            layout = self.layout_text(text, box_width, font_filename, font_size)
         mid_section = ((upper + lower) / 2)
-        y = mid_section - (height_of_text / 2)
-        # End of calculate y here
-
-        height = y
-        for index, line in enumerate(lines):
-            if place == 'left':
-                self.write_text((x, height), line, font_filename, font_size,
-                                color)
-            elif place == 'right':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = x + box_width - total_size[0]
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            elif place == 'center':
-                total_size = self.get_text_size(font_filename, font_size, line)
-                x_left = int(x + ((box_width - total_size[0]) / 2))
-                self.write_text((x_left, height), line, font_filename,
-                                font_size, color)
-            elif place == 'justify':
-                words = line.split()
-                if (index == len(lines) - 1 and not justify_last_line) or \
-                        len(words) == 1:
-                    self.write_text((x, height), line, font_filename, font_size,
-                                    color)
-                    continue
-                line_without_spaces = ''.join(words)
-                total_size = self.get_text_size(font_filename, font_size,
-                                                line_without_spaces)
-                space_width = (box_width - total_size[0]) / (len(words) - 1.0)
-                start_x = x
-                for word in words[:-1]:
-                    self.write_text((start_x, height), word, font_filename,
-                                    font_size, color)
-                    word_size = self.get_text_size(font_filename, font_size,
-                                                   word)
-                    start_x += word_size[0] + space_width
-                last_word_size = self.get_text_size(font_filename, font_size,
-                                                    words[-1])
-                last_word_x = x + box_width - last_word_size[0]
-                self.write_text((last_word_x, height), words[-1], font_filename,
-                                font_size, color)
-            height += text_height  # moved this to the end else a
-        return box_width, height - y
+        y = mid_section - (layout.height / 2)
+        return self.draw_layout(layout, (left_padding, y), color, place, justify_last_line)
@@ -0,0 +1,222 @@
+"""
+Counters and timers of a run, exported as a JSON summary and as a Prometheus textfile
+Every module records into the process-wide METRICS, e.g.
+    METRICS.increment("reddit_requests")
+    with METRICS.timer("render", kind="title"):
+        ...
+A metric can carry labels, which become Prometheus labels and "name{label=value}" JSON keys.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+PROMETHEUS_PREFIX = "insta_reddit_"
+
+
+def get_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_key(key, label_format="{}={}"):
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(label_format.format(*label) for label in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        """ Counters and timers, safe to update from several threads
+        """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}  # key: (count, total seconds, max seconds)
+        self.started_at = time.time()
+        self.export_to = None
+
+    def increment(self, name, value=1, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Record one duration of a timer
+        """
+        key = get_key(name, labels)
+        with self.lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Times the block, errors included
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def pop(self):
+        """
+        Returns the metrics recorded so far and starts over, e.g. to send them from a worker
+        process to the parent, which adds them up with merge()
+        :rtype: tuple(dict, dict)
+        """
+        with self.lock:
+            recorded = self.counters, self.timers
+            self.counters, self.timers = {}, {}
+        return recorded
+
+    def merge(self, recorded):
+        counters, timers = recorded
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (count, total, longest) in timers.items():
+                old_count, old_total, old_longest = self.timers.get(key, (0, 0.0, 0.0))
+                self.timers[key] = (old_count + count, old_total + total,
+                                    max(old_longest, longest))
+
+    def summary(self, **info):
+        """
+        JSON-friendly summary of the run
+        :param info: Extra fields, e.g. the command and whether it succeeded
+        :rtype: dict
+        """
+        with self.lock:
+            counters = {format_key(key): value for key, value in sorted(self.counters.items())}
+            timers = {format_key(key): {"count": count,
+                                        "total_seconds": total,
+                                        "mean_ms": total / count * 1000,
+                                        "max_ms": longest * 1000}
+                      for key, (count, total, longest) in sorted(self.timers.items())}
+        return dict(info, started_at=self.started_at,
+                    duration_seconds=time.time() - self.started_at,
+                    counters=counters, timers=timers)
+
+    def to_prometheus(self, labels=None, success=True):
+        """
+        Metrics in the Prometheus text format: counters as <name>_total,
+        timers as <name>_seconds summaries (_count, _sum) plus a <name>_seconds_max gauge
+        :param dict labels: Labels added to every sample, e.g. {"command": "fetch"}
+        :param success:     Whether the run succeeded, exported as last_run_success
+        :rtype: str
+        """
+        labels = labels or {}
+        common = tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+        def sample(name, key_labels, value):
+            return "{} {}".format(format_key((PROMETHEUS_PREFIX + name, common + key_labels),
+                                             '{}="{}"'), repr(float(value)))
+
+        lines = []
+        with self.lock:
+            counters, timers = dict(self.counters), dict(self.timers)
+        for name in sorted({name for name, _ in counters}):
+            lines.append("# TYPE {}{}_total counter".format(PROMETHEUS_PREFIX, name))
+            lines += [sample(name + "_total", key_labels, value)
+                      for (key_name, key_labels), value in sorted(counters.items())
+                      if key_name == name]
+        for name in sorted({name for name, _ in timers}):
+            lines.append("# TYPE {}{}_seconds summary".format(PROMETHEUS_PREFIX, name))
+            for (key_name, key_labels), (count, total, _) in sorted(timers.items()):
+                if key_name == name:
+                    lines.append(sample(name + "_seconds_count", key_labels, count))
+                    lines.append(sample(name + "_seconds_sum", key_labels, total))
+            lines.append("# TYPE {}{}_seconds_max gauge".format(PROMETHEUS_PREFIX, name))
+            lines += [sample(name + "_seconds_max", key_labels, longest)
+                      for (key_name, key_labels), (_, _, longest) in sorted(timers.items())
+                      if key_name == name]
+        lines.append("# TYPE {}last_run_timestamp_seconds gauge".format(PROMETHEUS_PREFIX))
+        lines.append(sample("last_run_timestamp_seconds", (), time.time()))
+        lines.append("# TYPE {}last_run_duration_seconds gauge".format(PROMETHEUS_PREFIX))
+        lines.append(sample("last_run_duration_seconds", (), time.time() - self.started_at))
+        lines.append("# TYPE {}last_run_success gauge".format(PROMETHEUS_PREFIX))
+        lines.append(sample("last_run_success", (), 1 if success else 0))
+        return "\n".join(lines) + "\n"
+
+    def configure_export(self, command, json_path=None, prometheus_dir=None):
+        """
+        Where export() writes the metrics
+        :param str command:         Name of the command running, e.g. fetch
+        :param str json_path:       File to write the JSON summary to
+        :param str prometheus_dir:  Folder read by node exporter's textfile collector,
+                                    written to insta_reddit_<command>.prom
+        """
+        self.export_to = (command, json_path, prometheus_dir)
+
+    def export(self, success=True):
+        """ Writes the metrics where configure_export() said, if anywhere
+        """
+        if self.export_to is None:
+            return
+        command, json_path, prometheus_dir = self.export_to
+        if json_path:
+            write_atomically(json_path, json.dumps(self.summary(command=command, success=success),
+                                                   indent=2))
+        if prometheus_dir:
+            write_atomically(os.path.join(prometheus_dir, "insta_reddit_{}.prom".format(command)),
+                             self.to_prometheus({"command": command}, success))
+
+
+def write_atomically(file_path, text):
+    """ Write to a temporary file first so a reader never sees half a file
+    """
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, file_path)
+
+
+@contextmanager
+def profiled(stats_path=None, top=20):
+    """
+    Run the block under cProfile if stats_path is set, saving the stats there for pstats/snakeviz
+    and printing the slowest functions. cProfile only sees the thread it is started from.
+    :param str stats_path:  File to dump the stats to, None to not profile
+    :param int top:         Number of functions to print
+    """
+    if stats_path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(stats_path)
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(top)
+        print(output.getvalue())
+        print("Profile saved to {}".format(stats_path))
+
+
+class InstrumentedClient:
+    """ Wraps an API client so every method call is counted and timed
+    """
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            METRICS.increment(self._name + "_calls", method=attr)
+            with METRICS.timer(self._name + "_call", method=attr):
+                return value(*args, **kwargs)
+        return call
+
+
+METRICS = Metrics()
@@ -0,0 +1,203 @@
+"""
+Find reposts of a tip reworded slightly, before they are stored, rendered and uploaded
+Titles are compared by MinHash signatures over character shingles of the normalized text.
+The signatures are split into bands and every band is hashed into a bucket (LSH), so a lookup
+only reads the posts sharing a bucket with the title, however large the index grows.
+The index is kept in content/near_duplicates.db and filled in as posts are stored.
+What happens to the near-duplicates found when fetching is set in credentials.py:
+    near_duplicates = "skip"  # default, don't store them; "flag" to store them anyway, "off"
+    near_duplicate_threshold = 0.6  # optional, similarity from which titles are near-duplicates
+Run this to (re)build it from the posts already stored:
+python insta_reddit/code/near_duplicates.py --rebuild
+"""
+import argparse
+import re
+import sqlite3
+import sys
+import zlib
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+import numpy as np
+
+from insta_reddit.code.storage import get_content_folder_path, get_db, get_local_instance
+
+SHINGLE_SIZE = 5  # Characters per shingle
+NUM_BANDS = 16
+ROWS_PER_BAND = 4  # Titles sharing about half their shingles will likely share a bucket
+NUM_HASHES = NUM_BANDS * ROWS_PER_BAND
+DEFAULT_THRESHOLD = 0.6  # Estimated Jaccard similarity above which a title is a near-duplicate
+MERSENNE_PRIME = (1 << 31) - 1
+
+# Fixed seed, the signatures have to stay comparable across runs
+_hash_params = np.random.RandomState(42).randint(1, MERSENNE_PRIME, size=(2, NUM_HASHES, 1),
+                                                 dtype=np.int64).astype(np.uint64)
+_shingle_weights = 256 ** np.arange(SHINGLE_SIZE, dtype=np.uint64)
+
+
+def normalize_text(text):
+    """ Lower case words and digits, so punctuation and spacing don't count as differences
+    """
+    return " ".join(re.findall(r"[a-z0-9]+", str(text).lower()))
+
+
+def get_signature(text):
+    """
+    MinHash signature of the character shingles of a text
+    :param str text: Title of a post
+    :return: NUM_HASHES minimums of the hashed shingles, one per hash function
+    :rtype: numpy.ndarray
+    """
+    # The normalized text is ASCII, so every shingle is SHINGLE_SIZE bytes read as one integer
+    text = normalize_text(text).encode("ascii").ljust(SHINGLE_SIZE)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np.frombuffer(text, dtype=np.uint8).astype(np.uint64), SHINGLE_SIZE)
+    hashes = np.unique(windows @ _shingle_weights % MERSENNE_PRIME)
+    multipliers, offsets = _hash_params
+    return ((multipliers * hashes + offsets) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+
+def get_band_keys(signature):
+    """ One bucket key per band, the band number included so bands don't collide
+    """
+    keys = []
+    for band, rows in enumerate(signature.reshape(NUM_BANDS, ROWS_PER_BAND)):
+        rows = rows.tobytes()
+        keys.append((zlib.crc32(rows, band) << 32 | zlib.crc32(rows)) - (1 << 63))  # Signed 64 bits
+    return keys
+
+
+def get_similarity(signature, other):
+    """ Estimated Jaccard similarity of the shingles of two texts
+    """
+    return float(np.mean(signature == other))
+
+
+class NearDuplicateIndex:
+    def __init__(self, db_path=None, threshold=DEFAULT_THRESHOLD):
+        """
+        Open (and create if needed) the index
+        :param str db_path:     Path of the SQLite file, defaults to content/near_duplicates.db
+        :param float threshold: Similarity from which a title counts as a near-duplicate
+        """
+        self.db_path = db_path or get_content_folder_path() + "/content/near_duplicates.db"
+        if self.db_path != ":memory:":
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS signatures ("
+                          "post_id TEXT PRIMARY KEY, signature BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                          "band_key INTEGER NOT NULL, post_id TEXT NOT NULL, "
+                          "PRIMARY KEY (band_key, post_id)) WITHOUT ROWID")
+        self.conn.commit()
+
+    def find(self, signature, pending=None, band_keys=None):
+        """
+        Most similar post indexed, or in pending, if it is a near-duplicate
+        :param signature:       Signature of the title to look up
+        :param dict pending:    Not yet indexed {band key: [(post ID, signature)]}
+        :param list band_keys:  get_band_keys(signature), if already computed
+        :return:                (post ID, similarity), or None if there is no near-duplicate
+        """
+        band_keys = band_keys or get_band_keys(signature)
+        candidates = {}
+        for band_key in band_keys:
+            for post_id, other in (pending or {}).get(band_key, []):
+                candidates[post_id] = other
+        found = self.conn.execute(
+            "SELECT DISTINCT signatures.post_id, signature FROM buckets "
+            "JOIN signatures ON signatures.post_id = buckets.post_id "
+            "WHERE band_key IN ({})".format(", ".join("?" * len(band_keys))), band_keys)
+        for post_id, blob in found:
+            candidates[post_id] = np.frombuffer(blob, dtype=np.uint32)
+        best = None
+        for post_id, other in candidates.items():
+            similarity = get_similarity(signature, other)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (post_id, similarity)
+        return best
+
+    def split(self, post_ids, texts):
+        """
+        Separate the near-duplicates of indexed posts, or of an earlier text of the batch
+        Nothing is indexed yet, pass the unique entries to add() once the posts are stored
+        :param list post_ids:   IDs of the posts
+        :param list texts:      Their titles
+        :return:                ([(post ID, signature)] of the unique posts,
+                                 {post ID: (ID of the post it repeats, similarity)})
+        :rtype:                 tuple(list, dict)
+        """
+        unique, duplicates, pending = [], {}, {}
+        for post_id, text in zip(post_ids, texts):
+            signature = get_signature(text)
+            band_keys = get_band_keys(signature)
+            found = self.find(signature, pending, band_keys)
+            if found is not None:
+                duplicates[post_id] = found
+                continue
+            unique.append((post_id, signature))
+            for band_key in band_keys:
+                pending.setdefault(band_key, []).append((post_id, signature))
+        return unique, duplicates
+
+    def add(self, entries):
+        """
+        Index posts
+        :param list entries: (post ID, signature) of each post, e.g. from split()
+        :return: None
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO signatures VALUES (?, ?)",
+                                  [(post_id, signature.tobytes()) for post_id, signature in entries])
+            self.conn.executemany("INSERT OR IGNORE INTO buckets VALUES (?, ?)",
+                                  [(band_key, post_id) for post_id, signature in entries
+                                   for band_key in get_band_keys(signature)])
+
+    def add_texts(self, post_ids, texts):
+        self.add([(post_id, get_signature(text)) for post_id, text in zip(post_ids, texts)])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM buckets")
+            self.conn.execute("DELETE FROM signatures")
+
+    def count(self):
+        """ Number of posts indexed
+        """
+        return self.conn.execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+
+
+def get_near_duplicate_index():
+    """ Returns the index for this process and thread
+    """
+    from insta_reddit import credentials  # Only needed once the index is used
+    return get_local_instance("near_duplicates", lambda: NearDuplicateIndex(threshold=getattr(
+        credentials, "near_duplicate_threshold", DEFAULT_THRESHOLD)))
+
+
+def rebuild(db, index=None):
+    """
+    Index every post stored, the oldest first so they are the ones later repeats point to
+    :param PostDb db: DB holding the posts
+    :return: Number of posts indexed
+    """
+    index = index or get_near_duplicate_index()
+    records = db.get_all_rows()
+    index.clear()
+    index.add_texts([record['id'] for record in records],
+                    [record['title'] for record in records])
+    return len(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                        help="""Index all the posts stored, e.g. the ones stored before the index
+                        existed""")
+    args = parser.parse_args()
+    if args.rebuild:
+        print("Indexed {} posts.".format(rebuild(get_db())))
+    print("Posts in the near-duplicate index: {}".format(get_near_duplicate_index().count()))
+    sys.exit(0)
@@ -0,0 +1,210 @@
+"""
+Run the whole flow in one process: fetch -> clean -> store -> render -> caption -> upload
+The stages run in their own threads joined by bounded queues, so a post can be rendered as soon as
+it is fetched, and a slow upload stage holds the upstream stages back instead of piling up work.
+The DB and the NLP models are loaded once and shared by every cycle.
+"""
+import argparse
+import queue
+import sys
+import threading
+import traceback
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.code.download_from_reddit import parse_specs, get_posts_for_specs, \
+    cleanup_content, save_posts_to_gsheets
+from insta_reddit.code.draw_text_on_image import write_on_img_safely
+from insta_reddit.code.fetch_checkpoints import FetchCheckpoints
+from insta_reddit.code.metrics import METRICS, profiled
+from insta_reddit.code.storage import get_db, sync_mirror, POST_COLUMNS
+from insta_reddit.code.captions import get_caption_store, get_lemmatizer
+from insta_reddit.code.upload_to_instagram import get_image_location, upload_posts
+
+STOP = object()  # Sent down the queues once a stage has nothing more to pass on
+
+
+class Pipeline:
+    def __init__(self, specs, fields=None, post_count=1, daemon=False, poll_interval=3600,
+                 upload_interval=60, queue_size=10, profile_render=None):
+        """
+        :param list specs:          List of (subreddit, listing, time_filter, limit) to fetch
+        :param fields:              List of fields to fetch
+        :param post_count:          Number of posts to upload per run, None for no limit.
+                                    Ignored in daemon mode, where upload_interval sets the pace
+        :param bool daemon:         Keep fetching every poll_interval seconds until interrupted
+        :param poll_interval:       Seconds between two fetches in daemon mode
+        :param upload_interval:     Seconds to wait after each upload
+        :param int queue_size:      Number of posts each queue holds before blocking its producer
+        :param profile_render:      Profile the render stage with cProfile and save the stats there
+        """
+        self.specs = specs
+        self.fields = fields
+        self.post_count = None if daemon else post_count
+        self.daemon = daemon
+        self.poll_interval = poll_interval
+        self.upload_interval = upload_interval
+        self.profile_render = profile_render
+
+        self.db = get_db(buffered=True)
+        self.db_lock = threading.Lock()  # The DB is shared by the fetch and upload stages
+        self.checkpoints = FetchCheckpoints()
+
+        self.render_queue = queue.Queue(maxsize=queue_size)
+        self.caption_queue = queue.Queue(maxsize=queue_size)
+        self.upload_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.uploaded_count = 0
+
+    def run(self):
+        """
+        Start the stages and wait for them to drain
+        :return int: Number of posts uploaded
+        """
+        stages = [(self.fetch_stage, None, self.render_queue),
+                  (self.render_stage, self.render_queue, self.caption_queue),
+                  (self.caption_stage, self.caption_queue, self.upload_queue),
+                  (self.upload_stage, self.upload_queue, None)]
+        threads = [threading.Thread(target=self.run_stage, args=stage, daemon=True)
+                   for stage in stages]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)  # Wake up regularly so Ctrl+C gets through
+        except KeyboardInterrupt:
+            print("Stopping, waiting for in-flight posts to finish.")
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            with self.db_lock:
+                self.db.flush()
+            sync_mirror(self.db)
+        if self.errors:
+            raise RuntimeError("Pipeline stage failed:\n{}".format("\n".join(self.errors)))
+        return self.uploaded_count
+
+    def run_stage(self, stage, input_queue, output_queue):
+        """ Runs a stage, stopping the pipeline if it fails and always passing STOP downstream
+        """
+        try:
+            stage()
+        except Exception:
+            self.errors.append(traceback.format_exc())
+            self.stop_event.set()
+            if input_queue is not None:
+                for _ in self.get_items(input_queue):  # Keep draining so upstream can't block
+                    pass
+        finally:
+            if output_queue is not None:
+                output_queue.put(STOP)
+
+    @staticmethod
+    def get_items(input_queue):
+        """ Yields the items of a queue until STOP
+        """
+        while True:
+            item = input_queue.get()
+            if item is STOP:
+                return
+            yield item
+
+    def fetch_stage(self):
+        with self.db_lock:
+            pending_records = self.db.get_unuploaded_rows()
+        for record in pending_records:  # Left over from earlier runs
+            if self.stop_event.is_set():
+                return
+            self.render_queue.put(record)
+        while not self.stop_event.is_set():
+            try:
+                records = self.fetch_new_records()
+            except Exception:
+                if not self.daemon:
+                    raise
+                # e.g. Reddit or Sheets unavailable for a while, the next cycle tries again
+                print("Fetch failed, retrying in {}s:\n{}".format(self.poll_interval,
+                                                                 traceback.format_exc()))
+                METRICS.increment("fetch_failures")
+                self.checkpoints = FetchCheckpoints()  # Drop what the failed cycle moved forward
+                records = []
+            for record in records:
+                self.render_queue.put(record)
+            if self.daemon:
+                METRICS.export()  # Scrapers see every cycle, not just the end of the run
+            if not self.daemon or self.stop_event.wait(self.poll_interval):
+                return
+
+    def fetch_new_records(self):
+        """
+        Fetch the listings from their checkpoints and store the posts not seen before
+        :return: The new posts as records
+        :rtype: list(dict)
+        """
+        content_df = get_posts_for_specs(self.specs, self.fields, checkpoints=self.checkpoints)
+        if content_df.empty:
+            print("No new posts.")
+            return []
+        with self.db_lock:
+            rows = save_posts_to_gsheets(cleanup_content(content_df), self.db)
+        self.checkpoints.save()
+        return [dict(zip(POST_COLUMNS, row)) for row in rows]
+
+    def render_stage(self):
+        with profiled(self.profile_render):
+            for record in self.get_items(self.render_queue):
+                if self.stop_event.is_set():
+                    continue  # Drain without doing any more work
+                post_id, error = write_on_img_safely(record)
+                if error is not None:
+                    print("Failed to generate image for ID: {}\n{}".format(post_id, error))
+                elif get_image_location(post_id):
+                    self.caption_queue.put(record)
+
+    def caption_stage(self):
+        get_lemmatizer()  # Load the NLP models before the first post arrives
+        for record in self.get_items(self.caption_queue):
+            if not self.stop_event.is_set():
+                caption = get_caption_store().precompute([record])[record['id']]
+                self.upload_queue.put((record, caption))
+
+    def upload_stage(self):
+        for record, caption in self.get_items(self.upload_queue):
+            if self.stop_event.is_set() or \
+                    (self.post_count is not None and self.uploaded_count >= self.post_count):
+                continue
+            if upload_posts(record, caption):
+                with self.db_lock:
+                    self.db.update_image_uploaded(record['id'])
+                    self.db.flush()  # Never upload it again if the process gets killed
+                self.uploaded_count += 1
+                self.stop_event.wait(self.upload_interval)
+
+
+def main(args):
+    if args.specs:
+        specs = parse_specs(args.specs)
+    else:
+        specs = [(str(args.subreddit_name), str(args.listing), str(args.time_filter),
+                  int(args.fetch_count))]
+    pipeline = Pipeline(specs,
+                        fields=args.fields.replace(" ", "").split(","),
+                        post_count=int(args.post_count),
+                        daemon=args.daemon,
+                        poll_interval=float(args.poll_interval),
+                        upload_interval=float(args.upload_interval),
+                        queue_size=int(args.queue_size),
+                        profile_render=args.profile_render)
+    print("Uploaded {} posts.".format(pipeline.run()))
+
+
+if __name__ == "__main__":
+    from insta_reddit.cli import add_run_arguments
+    parser = argparse.ArgumentParser()
+    add_run_arguments(parser)
+    main(args=parser.parse_args())
+    sys.exit(0)
@@ -0,0 +1,85 @@
+"""
+Thread-safe rate limiting shared by the API clients
+"""
+import threading
+import time
+from collections import deque
+
+
+class RateLimiter:
+    def __init__(self, rate, capacity=1):
+        """
+        Token bucket refilled at a steady rate
+        :param float rate:      Tokens added per second, i.e. the sustained number of calls per second
+        :param int capacity:    Largest burst of calls allowed after a quiet period
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.waited = 0.0  # Total seconds spent waiting for a token
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until the tokens are available, then take them
+        :param int tokens: Number of calls about to be made
+        :return float: Seconds spent waiting
+        """
+        with self.lock:  # Waiting under the lock keeps callers in FIFO-ish order
+            self._refill()
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            if wait > 0:
+                time.sleep(wait)
+                self._refill()
+            self.tokens -= tokens
+            self.waited += wait
+            return wait
+
+
+class SlidingWindowLimiter:
+    def __init__(self, quota, window=60.0):
+        """
+        At most quota calls in any window of time, like the per-minute quotas of Google APIs
+        :param int quota:       Calls allowed per window
+        :param float window:    Length of the window in seconds
+        """
+        self.quota = quota
+        self.window = window
+        self.calls = deque()  # Times of the calls made in the current window
+        self.waited = 0.0  # Total seconds spent waiting for the quota
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.calls and self.calls[0] <= now - self.window:
+            self.calls.popleft()
+
+    def acquire(self):
+        """
+        Block until a call fits in the quota, then count it
+        :return float: Seconds spent waiting
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            wait = 0.0
+            if len(self.calls) >= self.quota:
+                wait = self.calls[0] + self.window - now
+                time.sleep(wait)
+                now = time.monotonic()
+                self._expire(now)
+            self.calls.append(now)
+            self.waited += wait
+            return wait
+
+    def usage(self):
+        """ Number of calls made in the current window
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            return len(self.calls)
@@ -1,19 +1,94 @@
 # https://gspread.readthedocs.io/en/latest/oauth2.html#for-bots-using-service-account
 # NOTE: Google Sheets cells are 1-base indexed
+import atexit
+import time
 import warnings
 import gspread
 
+from insta_reddit.code.metrics import InstrumentedClient
+from insta_reddit.code.sheets_scheduler import SheetsScheduler
+from insta_reddit.code.storage import PostDb, POST_COLUMNS
 
-class SheetsDb:
-    def __init__(self, sheet_id, credentials_path=None):
+
+class SheetsDb(PostDb):
+    def __init__(self, sheet_id, credentials_path=None, buffered=False,
+                 flush_size=50, flush_interval=60, worksheet=None, read_quota=None,
+                 write_quota=None):
         """
         Initialize gspread handler with credentials
         :param sheet_id: The long-ass alphanumeric code in the URL of the Google Sheet
         :param credentials_path: If None, will look at ~/.config/gspread/service_account.json
+        :param buffered:        If True, status updates are held in memory and written in bulk
+        :param flush_size:      Flush the buffer once it holds this many pending cell updates
+        :param flush_interval:  Flush the buffer once this many seconds passed since the last flush
+        :param worksheet:       Worksheet to use instead of opening sheet_id, e.g. an offline fake
+        :param read_quota:      Read requests per minute, see sheets_scheduler.py
+        :param write_quota:     Write requests per minute
         """
-        self.gc = gspread.service_account(filename=credentials_path)
         self.sheet_id = sheet_id
-        self.sheet = self.gc.open_by_key(sheet_id).sheet1
+        if worksheet is None:
+            self.gc = gspread.service_account(filename=credentials_path)
+            worksheet = self.gc.open_by_key(sheet_id).sheet1
+        else:
+            self.gc = None
+        # Calls go through the scheduler, which keeps them within the quotas and batches writes,
+        # then through the instrumentation counting and timing every call actually sent
+        self.sheet = SheetsScheduler(InstrumentedClient(worksheet, "sheets_api"),
+                                     read_quota=read_quota, write_quota=write_quota)
+        # Lazily loaded caches of the header row and the id column, see load_index()
+        self._colnames = None
+        self._id_to_row = None
+        self._row_count = None
+        # Write-behind buffer of status updates, keyed by (row, col) so the latest value wins
+        self.buffered = buffered
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        if self.buffered:
+            atexit.register(self.flush)  # Never drop acknowledged updates on interpreter exit
+
+    def load_index(self):
+        """
+        Read the header row and the id column once and cache them in memory
+        Subsequent lookups are answered from the cache without hitting the Sheets API
+        Both are read in one request when the id column is where download_from_reddit.py puts it
+        :return: None
+        """
+        expected_col = POST_COLUMNS.index("id") + 1
+        col_letter = gspread.utils.rowcol_to_a1(1, expected_col)[:-1]
+        header, id_column = self.sheet.get_ranges(["1:1", "{0}:{0}".format(col_letter)])
+        self._colnames = list(header[0]) if header else []
+        if self._colnames.index("id") + 1 == expected_col:
+            id_list = [row[0] if row else "" for row in id_column]
+        else:
+            id_list = self.sheet.col_values(self._colnames.index("id") + 1)
+        self._id_to_row = {}
+        for idx, post_id in enumerate(id_list):
+            self._id_to_row.setdefault(post_id, idx + 1)  # Keep the first occurrence of an ID
+        self._row_count = len(id_list)
+
+    def invalidate_index(self):
+        """
+        Drop the cached header and id column, e.g. after another process has written to the sheet
+        The cache is reloaded on the next lookup
+        :return: None
+        """
+        self._colnames = None
+        self._id_to_row = None
+        self._row_count = None
+
+    def refresh(self):
+        """
+        Reload the cached header and id column from the sheet right away
+        :return: None
+        """
+        self.invalidate_index()
+        self.load_index()
+
+    def _ensure_index(self):
+        if self._id_to_row is None:
+            self.load_index()
 
     def get_row_for_id(self, post_id: str) -> int:
         """
@@ -21,12 +96,8 @@ class SheetsDb:
         :param str post_id: Reddit post ID
         :return int: The index of the row the ID is on
         """
-        id_col = self.get_index_for_column("id")
-        id_list = self.sheet.col_values(id_col)
-        try:
-            return id_list.index(post_id) + 1
-        except ValueError as _:
-            return -1
+        self._ensure_index()
+        return self._id_to_row.get(post_id, -1)
 
     def get_index_for_column(self, colname: str) -> int:
         """
@@ -34,8 +105,8 @@ class SheetsDb:
         :param str colname: Name of the column, e.g. image_uploaded
         :return int: The index of the column the colname is on
         """
-        colnames = self.sheet.row_values(1)
-        return colnames.index(colname) + 1
+        self._ensure_index()
+        return self._colnames.index(colname) + 1
 
     def update_image_uploaded(self, post_id: str):
         """
@@ -43,24 +114,114 @@ class SheetsDb:
         :param str post_id: The "id" of the Reddit post to be uploaded
         :return: None
         """
-        col_idx = self.get_index_for_column("image_uploaded")
+        self.update_status(post_id, "image_uploaded", "TRUE")
+
+    def update_status(self, post_id: str, colname: str, value):
+        """
+        Set a status column of a post, e.g. image_uploaded
+        In buffered mode the update is queued and written by the next flush()
+        :param str post_id: The "id" of the Reddit post
+        :param str colname: Name of the status column
+        :param value:       Value to write to the cell
+        :return: None
+        """
+        col_idx = self.get_index_for_column(colname)
         row_idx = self.get_row_for_id(post_id)
-        if self.sheet.cell(row_idx, col_idx).value == "TRUE":
-            warnings.warn("Cell at {}, {} already updated to True.".format(row_idx, col_idx))
+        if row_idx == -1:
+            warnings.warn("ID {} not found, skipping update of {}.".format(post_id, colname))
+            return
+        if self.buffered:
+            self._pending[(row_idx, col_idx)] = value
+            if len(self._pending) >= self.flush_size or \
+                    time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        elif self.sheet.cell(row_idx, col_idx).value == str(value):
+            warnings.warn("Cell at {}, {} already updated to {}.".format(row_idx, col_idx, value))
         else:
-            self.sheet.update_cell(row_idx, col_idx, "TRUE")
+            self.sheet.update_cell(row_idx, col_idx, value)
+            self.sheet.flush()
+
+    def flush(self):
+        """
+        Write all the buffered status updates and appended rows to the sheet in a single
+        batch_update. If it fails, the scheduler keeps them for the next attempt
+        :return: None
+        """
+        self._last_flush = time.monotonic()
+        pending = self._pending
+        self._pending = {}
+        if pending:
+            self.sheet.batch_update([{"range": gspread.utils.rowcol_to_a1(row_idx, col_idx),
+                                      "values": [[value]]}
+                                     for (row_idx, col_idx), value in pending.items()])
+        self.sheet.flush()
+        if pending:
+            print("Flushed {} status updates.".format(len(pending)))
+
+    def get_all_ids(self) -> set:
+        """
+        Returns the set of all post IDs already present in the sheet
+        :rtype: set(str)
+        """
+        self._ensure_index()
+        return set(self._id_to_row.keys())
 
-    def append_row(self, row: list, col_idx: int = 1):
+    def append_row(self, row: list, col_idx: int = None):
         """
         Append a list after the last cell of the given column
         :param list row:    Row to append
         :param int col_idx: Which column to use to decide the last cell beyond which to append
+                            If None, the cached length of the id column is used
+        :return: None
+        """
+        self.append_rows([row], col_idx=col_idx)
+
+    def append_rows(self, rows: list, col_idx: int = None):
+        """
+        Append several rows after the last cell of the given column in a single write request
+        In buffered mode the request is sent with the next flush(), along with the status updates
+        :param list rows:   List of rows (each a list) to append
+        :param int col_idx: Which column to use to decide the last cell beyond which to append
+                            If None, the cached length of the id column is used
         :return: None
         """
-        last_row_idx = len(self.sheet.col_values(col_idx))
-        for idx, elem in enumerate(row):
-            self.sheet.update_cell(last_row_idx + 1, idx + 1, elem)
-        print("Row {} appended.".format(last_row_idx + 1))
+        if not rows:
+            return
+        self._ensure_index()
+        if col_idx is None or col_idx == self.get_index_for_column("id"):
+            last_row_idx = self._row_count
+        else:
+            last_row_idx = len(self.sheet.col_values(col_idx))
+        first_row_idx = last_row_idx + 1
+        self.sheet.update(range_name=gspread.utils.rowcol_to_a1(first_row_idx, 1),
+                          values=[list(row) for row in rows])
+        if not self.buffered:
+            self.sheet.flush()
+        for offset, row in enumerate(rows):
+            self._track_appended_row(row, first_row_idx + offset)
+        if len(rows) == 1:
+            print("Row {} appended.".format(first_row_idx))
+        else:
+            print("Rows {} to {} appended.".format(first_row_idx, first_row_idx + len(rows) - 1))
+
+    def _track_appended_row(self, row: list, row_idx: int):
+        """
+        Keep the cached id column in step with a row this instance has written
+        :param list row:    Row that was written
+        :param int row_idx: The index of the row it was written to
+        :return: None
+        """
+        id_col = self.get_index_for_column("id")
+        if len(row) >= id_col:
+            self._id_to_row.setdefault(str(row[id_col - 1]), row_idx)
+            self._row_count = max(self._row_count, row_idx)
+
+    def get_all_rows(self):
+        """
+        Get all the records, in the order of the sheet
+        :rtype: list(dict)
+        """
+        return self.sheet.get_all_records()
 
     def get_unuploaded_rows(self):
         """
@@ -0,0 +1,239 @@
+"""
+Client-side scheduling of the Google Sheets API calls of a worksheet
+Google allows a number of read and of write requests per minute and per user, and answers 429
+beyond that. The scheduler keeps the calls within these quotas, merges the writes waiting to be
+sent into a single batch_update and the cells, rows and columns read at the same time by
+several threads into a single batch_get, and retries the calls that still get rate limited.
+The quotas can be set in credentials.py:
+    sheets_read_quota = 60  # optional, read requests per minute
+    sheets_write_quota = 60  # optional, write requests per minute
+"""
+import atexit
+import random
+import threading
+import time
+
+import gspread
+
+from insta_reddit.code.metrics import METRICS
+from insta_reddit.code.rate_limit import SlidingWindowLimiter
+
+DEFAULT_READ_QUOTA = 60  # Per user per minute, the default quotas of the Sheets API
+DEFAULT_WRITE_QUOTA = 60
+QUOTA_WINDOW = 60
+RETRY_STATUS_CODES = [429, 500, 502, 503]  # Rate limited, or a transient error of the backend
+
+
+def get_status_code(error):
+    """ HTTP status code of a gspread APIError
+    """
+    return getattr(error.response, "status_code", error.code)
+
+
+class SheetsScheduler:
+    def __init__(self, worksheet, read_quota=None, write_quota=None, max_retries=5, backoff=2,
+                 max_backoff=64, max_pending=1000):
+        """
+        Sits in front of a worksheet, with the same methods
+        Writes (update, update_cell, batch_update) are held until flush(), the next read, or
+        max_pending value ranges, then sent together in one batch_update
+        Reads of cells, rows and columns waiting for another read to finish are sent together
+        :param worksheet:       gspread Worksheet
+        :param int read_quota:  Read requests allowed per minute, defaults to DEFAULT_READ_QUOTA
+        :param int write_quota: Write requests allowed per minute, defaults to DEFAULT_WRITE_QUOTA
+        :param int max_retries: Attempts after the first one before giving up on a request
+        :param float backoff:   Seconds to wait before the first retry, doubled on every retry
+        :param float max_backoff:   Longest wait before a retry
+        :param int max_pending: Flush the held writes once there are this many value ranges
+        """
+        self.worksheet = worksheet
+        self.limiters = {"read": SlidingWindowLimiter(read_quota or DEFAULT_READ_QUOTA,
+                                                      QUOTA_WINDOW),
+                         "write": SlidingWindowLimiter(write_quota or DEFAULT_WRITE_QUOTA,
+                                                       QUOTA_WINDOW)}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self.pending = []  # (raw, value range) of the writes not sent yet, in order
+        self.isolate = 0  # Number of pending writes to send one by one, to find the invalid one
+        self.lock = threading.RLock()
+        self.reads = []  # Requests of the threads waiting for their ranges, see get_ranges()
+        self.reading = False
+        self.reads_lock = threading.Lock()
+        self.retries = 0
+        self.backoff_waited = 0.0  # Total seconds spent waiting before retries
+        atexit.register(self.close)
+
+    def __getattr__(self, attr):
+        """ Any other method is a read: the held writes are sent first so it sees them
+        """
+        value = getattr(self.worksheet, attr)
+        if not callable(value):
+            return value
+
+        def read(*args, **kwargs):
+            with self.lock:
+                self.flush()
+                return self.call("read", value, *args, **kwargs)
+        return read
+
+    def call(self, kind, method, *args, **kwargs):
+        """
+        Make a request within the quota of its kind, retrying it if it is rate limited anyway
+        :param str kind:    read or write
+        :param method:      Method of the worksheet to call
+        :return:            What the method returns
+        """
+        for attempt in range(self.max_retries + 1):
+            wait = self.limiters[kind].acquire()
+            METRICS.observe("sheets_quota_wait", wait, kind=kind)
+            if wait > 1:
+                print("Sheets {} quota used up, waited {:.1f}s.".format(kind, wait))
+            try:
+                return method(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status_code = get_status_code(e)
+                if status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    raise
+                retry_after = e.response.headers.get("Retry-After", "")
+                delay = float(retry_after) if retry_after.isdigit() else \
+                    min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                print("Sheets API answered {}, retrying in {:.1f}s.".format(status_code, delay))
+                METRICS.increment("sheets_retries", status=status_code)
+                METRICS.observe("sheets_backoff_wait", delay)
+                self.retries += 1
+                self.backoff_waited += delay
+                time.sleep(delay)
+
+    def get_ranges(self, ranges):
+        """
+        Values of A1 ranges, read in one batch_get along with the ranges other threads asked for
+        while the previous batch_get was on its way
+        :param list ranges: e.g. ["B2", "1:1", "E:E"]
+        :return: A list of rows for each range
+        :rtype: list
+        """
+        request = {"ranges": list(ranges), "done": threading.Event()}
+        with self.reads_lock:
+            self.reads.append(request)
+            leader = not self.reading
+            self.reading = True
+        if leader:  # Send the reads queued up until there are none left
+            while True:
+                with self.reads_lock:
+                    batch, self.reads = self.reads, []
+                    if not batch:
+                        self.reading = False
+                        break
+                self._read_batch(batch)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["values"]
+
+    def _read_batch(self, batch):
+        ranges = list(dict.fromkeys(range_name for request in batch
+                                    for range_name in request["ranges"]))
+        try:
+            with self.lock:
+                self.flush()
+                found = dict(zip(ranges, self.call("read", self.worksheet.batch_get, ranges)))
+            METRICS.increment("sheets_reads_merged", len(batch))
+            for request in batch:
+                request["values"] = [found[range_name] for range_name in request["ranges"]]
+        except Exception as e:
+            for request in batch:
+                request["error"] = e
+        for request in batch:
+            request["done"].set()
+
+    def cell(self, row, col, **kwargs):
+        if kwargs:
+            return self.__getattr__("cell")(row, col, **kwargs)
+        values = self.get_ranges([gspread.utils.rowcol_to_a1(row, col)])[0]
+        return gspread.cell.Cell(row, col, values[0][0] if values and values[0] else "")
+
+    def row_values(self, row, **kwargs):
+        if kwargs:
+            return self.__getattr__("row_values")(row, **kwargs)
+        values = self.get_ranges(["{0}:{0}".format(row)])[0]
+        return list(values[0]) if values else []
+
+    def col_values(self, col, **kwargs):
+        if kwargs:
+            return self.__getattr__("col_values")(col, **kwargs)
+        col_letter = gspread.utils.rowcol_to_a1(1, col)[:-1]
+        values = self.get_ranges(["{0}:{0}".format(col_letter)])[0]
+        return [row[0] if row else "" for row in values]
+
+    def _hold(self, value_ranges, raw=True):
+        with self.lock:
+            self.pending += [(raw, value_range) for value_range in value_ranges]
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+
+    def update(self, values=None, range_name=None, raw=True, **kwargs):
+        if kwargs:  # Options batch_update doesn't take for each range, send it as is
+            with self.lock:
+                self.flush()
+                return self.call("write", self.worksheet.update, values=values,
+                                 range_name=range_name, raw=raw, **kwargs)
+        self._hold([{"range": range_name, "values": values}], raw)
+
+    def update_cell(self, row, col, value):
+        # Like gspread, the value is parsed as if typed in, e.g. "TRUE" becomes a boolean
+        self._hold([{"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}],
+                   raw=False)
+
+    def batch_update(self, data, raw=True, **kwargs):
+        if kwargs:
+            with self.lock:
+                self.flush()
+                return self.call("write", self.worksheet.batch_update, data, raw=raw, **kwargs)
+        self._hold(list(data), raw)
+
+    def flush(self):
+        """
+        Send the held writes, in one batch_update per value input option
+        If a request is still rate limited after the retries, it and the writes after it are kept
+        for the next flush. Writes the API rejects, e.g. with 400 for an invalid range, are dropped
+        :return: None
+        """
+        with self.lock:
+            while self.pending:
+                raw = self.pending[0][0]
+                count = 1 if self.isolate else next(
+                    (i for i, (other_raw, _) in enumerate(self.pending) if other_raw != raw),
+                    len(self.pending))
+                try:
+                    self.call("write", self.worksheet.batch_update,
+                              [value_range for _, value_range in self.pending[:count]], raw=raw)
+                    METRICS.increment("sheets_writes_merged", count)
+                except gspread.exceptions.APIError as e:
+                    if get_status_code(e) in RETRY_STATUS_CODES:
+                        raise
+                    if count > 1:  # Send them one by one, so only the invalid ones get dropped
+                        self.isolate = count
+                        continue
+                    print("Sheets API rejected the write to {}, dropping it: {}".format(
+                        self.pending[0][1]["range"], e))
+                    METRICS.increment("sheets_writes_dropped")
+                self.isolate = max(0, self.isolate - 1)
+                del self.pending[:count]
+
+    def quota_waited(self):
+        """ Seconds spent waiting for the read and write quotas
+        """
+        return sum(limiter.waited for limiter in self.limiters.values())
+
+    def close(self):
+        """ Send the held writes and report the time spent waiting on the API, if any
+        """
+        try:
+            self.flush()
+        except gspread.exceptions.APIError as e:
+            print("Could not send {} writes to the sheet: {}".format(len(self.pending), e))
+        if self.quota_waited() or self.retries:
+            print("Waited {:.1f}s on the Sheets quotas, and {:.1f}s before {} retries.".format(
+                self.quota_waited(), self.backoff_waited, self.retries))
@@ -0,0 +1,97 @@
+"""
+Local SQLite implementation of the posts DB
+Rows are indexed by post ID, so lookups stay fast however large the archive gets.
+"""
+import sqlite3
+from pathlib import Path
+
+from insta_reddit.code.storage import PostDb, POST_COLUMNS, STATUS_COLUMNS
+
+
+class SqliteDb(PostDb):
+    def __init__(self, db_path, buffered=False):
+        """
+        Open (and create if needed) the SQLite posts DB
+        :param str db_path:     Path of the SQLite file, or ":memory:"
+        :param bool buffered:   If True, writes are only committed on flush()
+        """
+        if db_path != ":memory:":
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.buffered = buffered
+        # Shared by the stages of pipeline.py, which serialize their calls
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("CREATE TABLE IF NOT EXISTS posts ("
+                          "title TEXT, selftext TEXT, author TEXT, url TEXT, "
+                          "id TEXT NOT NULL UNIQUE, "
+                          "image_uploaded TEXT NOT NULL DEFAULT 'FALSE')")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS posts_image_uploaded "
+                          "ON posts (image_uploaded)")
+        self.conn.commit()
+
+    def _commit(self):
+        if not self.buffered:
+            self.conn.commit()
+
+    def flush(self):
+        self.conn.commit()
+
+    def get_row_for_id(self, post_id: str) -> int:
+        found = self.conn.execute("SELECT rowid FROM posts WHERE id = ?", (post_id,)).fetchone()
+        return found[0] if found else -1
+
+    def get_all_ids(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT id FROM posts")}
+
+    def append_rows(self, rows: list):
+        if not rows:
+            return
+        self.conn.executemany("INSERT OR IGNORE INTO posts ({}) VALUES (?, ?, ?, ?, ?)".format(
+            ", ".join(POST_COLUMNS)), [list(row[:len(POST_COLUMNS)]) for row in rows])
+        self._commit()
+        print("{} rows appended.".format(len(rows)))
+
+    def get_all_rows(self):
+        return [dict(row) for row in self.conn.execute("SELECT * FROM posts ORDER BY rowid")]
+
+    def get_unuploaded_rows(self):
+        return [dict(row) for row in
+                self.conn.execute("SELECT * FROM posts WHERE image_uploaded != 'TRUE' "
+                                  "ORDER BY rowid")]
+
+    def update_status(self, post_id: str, colname: str, value):
+        if colname not in STATUS_COLUMNS:  # Column names can't be bound as query parameters
+            raise ValueError("Unknown status column: {}".format(colname))
+        self.conn.execute("UPDATE posts SET {} = ? WHERE id = ?".format(colname),
+                          (str(value), post_id))
+        self._commit()
+
+    def sync_with_sheets(self, sdb):
+        """
+        Two-way bulk sync with a Google Sheets mirror:
+        rows missing on either side are copied over, and uploaded statuses are pushed to the sheet
+        :param SheetsDb sdb: The Google Sheet to mirror to, preferably in buffered mode
+        :return: None
+        """
+        sheet_records = {str(record["id"]): record for record in sdb.sheet.get_all_records()}
+        local_ids = self.get_all_ids()
+
+        # Pull rows only present in the sheet
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO posts ({}, image_uploaded) VALUES (?, ?, ?, ?, ?, ?)".format(
+                ", ".join(POST_COLUMNS)),
+            [[record.get(col, "") for col in POST_COLUMNS] +
+             ["TRUE" if record.get("image_uploaded") == "TRUE" else "FALSE"]
+             for post_id, record in sheet_records.items() if post_id not in local_ids])
+        self.conn.commit()
+
+        # Push rows and uploaded statuses only present locally
+        local_rows = [dict(row) for row in self.conn.execute("SELECT * FROM posts ORDER BY rowid")]
+        sdb.append_rows([[row[col] for col in POST_COLUMNS] for row in local_rows
+                         if row["id"] not in sheet_records])
+        for row in local_rows:
+            if row["image_uploaded"] == "TRUE" and \
+                    sheet_records.get(row["id"], {}).get("image_uploaded") != "TRUE":
+                sdb.update_image_uploaded(row["id"])
+        sdb.flush()
@@ -0,0 +1,30 @@
+"""
+Print where the posts are in the flow: stored, rendered, captioned, uploaded
+"""
+import sys
+from pathlib import Path
+git_root = str(Path(__file__).parent.parent.parent.resolve())
+sys.path.append(git_root)
+
+from insta_reddit.code.captions import get_caption_store
+from insta_reddit.code.fetch_checkpoints import FetchCheckpoints
+from insta_reddit.code.image_manifest import get_manifest
+from insta_reddit.code.storage import get_db
+
+
+def main(args=None):
+    sdb = get_db()
+    print("Posts stored: {}".format(len(sdb.get_all_ids())))
+    print("Posts yet to be uploaded: {}".format(len(sdb.get_unuploaded_rows())))
+    image_counts = get_manifest().get_counts()
+    print("Images generated: {}, uploaded: {} ({} packed)".format(
+        image_counts.get("generated", 0), image_counts.get("uploaded", 0),
+        get_manifest().get_packed_count()))
+    print("Captions precomputed: {}".format(get_caption_store().count()))
+    for key, checkpoint in sorted(FetchCheckpoints().checkpoints.items()):
+        print("Checkpoint {}: {} ({})".format(key, checkpoint["id"], checkpoint["created_utc"]))
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,164 @@
+"""
+Storage backends for the posts DB
+Google Sheets (SheetsDb) and a local SQLite file (SqliteDb) share the PostDb interface.
+The backend is chosen in credentials.py:
+    storage_backend = "sheets"  # or "sqlite"
+    sqlite_path = "/path/to/posts.db"  # optional, defaults to content/posts.db
+    sheets_mirror = True  # optional, sync the SQLite DB with the Google Sheet in bulk
+"""
+import os
+import threading
+
+# Order of the columns in a row, as written by download_from_reddit.py
+POST_COLUMNS = ["title", "selftext", "author", "url", "id"]
+STATUS_COLUMNS = ["image_uploaded"]
+
+
+class PostDb:
+    """
+    Interface shared by all the storage backends
+    """
+    def get_row_for_id(self, post_id: str) -> int:
+        """
+        Finds the row given the ID, returns -1 if not found
+        :param str post_id: Reddit post ID
+        :return int: The index of the row the ID is on
+        """
+        raise NotImplementedError
+
+    def get_all_ids(self) -> set:
+        """
+        Returns the set of all post IDs already stored
+        :rtype: set(str)
+        """
+        raise NotImplementedError
+
+    def append_row(self, row: list):
+        """
+        Append a single row, with values in the order of POST_COLUMNS
+        :param list row: Row to append
+        :return: None
+        """
+        self.append_rows([row])
+
+    def append_rows(self, rows: list):
+        """
+        Append several rows, each with values in the order of POST_COLUMNS
+        :param list rows: List of rows (each a list) to append
+        :return: None
+        """
+        raise NotImplementedError
+
+    def get_all_rows(self):
+        """
+        Get all the records, in the order they were stored
+        :rtype: list(dict)
+        """
+        raise NotImplementedError
+
+    def get_unuploaded_rows(self):
+        """
+        Get all the records that are yet to be uploaded
+        :rtype: list(dict)
+        """
+        raise NotImplementedError
+
+    def update_image_uploaded(self, post_id: str):
+        """
+        Mark the image of a post as uploaded
+        :param str post_id: The "id" of the Reddit post that was uploaded
+        :return: None
+        """
+        self.update_status(post_id, "image_uploaded", "TRUE")
+
+    def update_status(self, post_id: str, colname: str, value):
+        """
+        Set a status column of a post, e.g. image_uploaded
+        :param str post_id: The "id" of the Reddit post
+        :param str colname: Name of the status column
+        :param value:       Value to write
+        :return: None
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Persist any buffered writes
+        :return: None
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        return False
+
+
+def get_content_folder_path():
+    """ Path of the insta_reddit folder holding credentials, content etc.
+    """
+    return "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1])
+
+
+_local = threading.local()
+
+
+def get_local_instance(name, factory):
+    """
+    Returns the instance of a store for this process and thread, creating it on first use
+    SQLite connections can't be shared across a fork, nor by default across threads. The instances
+    are thread-local, so they are dropped along with their thread
+    :param str name:    Name of the store, e.g. "captions"
+    :param factory:     Called without arguments to create the instance
+    """
+    if getattr(_local, "pid", None) != os.getpid():  # First use in this thread, or a forked child
+        _local.pid, _local.instances = os.getpid(), {}
+    if name not in _local.instances:
+        _local.instances[name] = factory()
+    return _local.instances[name]
+
+
+def get_sheets_db(buffered=False):
+    """ Returns a SheetsDb for the Google Sheet configured in credentials.py
+    """
+    # Imported when a DB is opened, so importing the modules works without a credentials.py
+    from insta_reddit import credentials
+    from insta_reddit.code.sheets_db import SheetsDb  # Only import gspread when it is needed
+    return SheetsDb(sheet_id=credentials.sheets_url,
+                    credentials_path=get_content_folder_path() + "/service_account.json",
+                    buffered=buffered,
+                    read_quota=getattr(credentials, "sheets_read_quota", None),
+                    write_quota=getattr(credentials, "sheets_write_quota", None))
+
+
+def get_db(buffered=False):
+    """
+    Returns the storage backend configured in credentials.py (Google Sheets by default)
+    :param bool buffered: Whether status updates can be buffered until flush()
+    :rtype: PostDb
+    """
+    from insta_reddit import credentials
+    backend = getattr(credentials, "storage_backend", "sheets")
+    if backend == "sheets":
+        return get_sheets_db(buffered=buffered)
+    if backend == "sqlite":
+        from insta_reddit.code.sqlite_db import SqliteDb
+        db_path = getattr(credentials, "sqlite_path", None) or \
+            get_content_folder_path() + "/content/posts.db"
+        return SqliteDb(db_path, buffered=buffered)
+    raise ValueError("Unknown storage backend: {}".format(backend))
+
+
+def sync_mirror(db):
+    """
+    Sync a local DB with its Google Sheets mirror if sheets_mirror is set in credentials.py
+    :param PostDb db: The DB in use
+    :return: None
+    """
+    from insta_reddit import credentials
+    if getattr(credentials, "sheets_mirror", False) and hasattr(db, "sync_with_sheets"):
+        db.flush()
+        with get_sheets_db(buffered=True) as sdb:
+            db.sync_with_sheets(sdb)
@@ -3,81 +3,30 @@ Upload to instagram
 Check GSheets for images not uploaded yet
 Check if those IDs are available in images/generated
 If found, check if it also contains a self_text
-Upload them together, move them to uploaded, and update GSheets with post ID
+Upload them together, move them to their shard of uploaded, and update GSheets with post ID
 """
 
 # TODO: See if multiple photo uploads is supported
-import os
-import shutil
-import glob
 import argparse
+import random
 import sys
+import time
+from collections import deque
 from pathlib import Path
 git_root = str(Path(__file__).parent.parent.parent.resolve())
 sys.path.append(git_root)
-import html
 
-import nltk
-from nltk.stem import WordNetLemmatizer
+from insta_reddit.code.captions import get_caption, get_caption_store
+from insta_reddit.code.image_manifest import get_manifest
+from insta_reddit.code.metrics import METRICS
+from insta_reddit.code.rate_limit import RateLimiter
+from insta_reddit.code.storage import get_db, sync_mirror, get_content_folder_path
 
-from instabot import Bot
-from insta_reddit import credentials
-from insta_reddit.code.sheets_db import SheetsDb
-
-DEFAULT_CAPTION_PREFIX = "Unethical life pro tips be like... "
-DEFAULT_HASHTAGS = " #lifeprotips #lpt"
-MAX_NUM_HASHTAGS = 18
-
-
-def get_hashtags(text):
-    """
-    Returns a string of hashtags generated from the text
-    :param str text:    The text of the title
-    :return:            Space separated hashtags generated
-    :rtype:             str
-    """
-    """
-    # NOTE: Run the following lines from a Python console to enable hashtag generation:
-    import nltk
-    nltk.download("punkt")
-    nltk.download('averaged_perceptron_tagger')
-    nltk.download('wordnet')
-    """
-    # TODO: Remove stopwords
-    lemmatizer = WordNetLemmatizer()
-    hashtags = list(set([lemmatizer.lemmatize(word)
-                         for (word, pos) in nltk.pos_tag(nltk.word_tokenize(text))
-                         if pos[0] == 'N']))  # use nouns to get hashtags
-    hashtag_string = "#" + " #".join(hashtags[:min(len(hashtags), (MAX_NUM_HASHTAGS - 4))]) \
-        if len(hashtags) > 0 \
-        else ""  # total upto 15+4 = 19 hashtags (any more and Instagram starts lowering SEO)
-    hashtag_string += DEFAULT_HASHTAGS
-    print("Hashtags generated: {}".format(hashtag_string))
-    return hashtag_string
-
-
-def get_caption(record):
-    """
-    Return the complete caption for a post
-    :param dict record: dict containing 'title', 'author', 'url' in its keys
-    :return:            caption for the post to be uploaded
-    :rtype:             str
-    """
-    hashtags = get_hashtags(record['title'])
-    author, url = record['author'], record['url']
-    prefix_text = DEFAULT_CAPTION_PREFIX
-    if record['selftext']:
-        st = html.unescape(record['selftext'])
-        prefix_text = st
-    return prefix_text + hashtags + \
-           "  Author: u/{}  URL: {}".format(author, url)
+DEFAULT_MIN_UPLOAD_INTERVAL = 60  # Seconds between two uploads, overridable in credentials.py
 
 
 def move_to_uploaded(file_path):
-    shutil.move(file_path, "uploaded".join(file_path.rsplit("generated", 1)))
-    # This syntax is to replace the last occurrence of generated in the file path with uploaded
-    # to avoid a potential "generated" string in some other part of the filepath getting replaced
-    pass
+    return get_manifest().move_to_uploaded(file_path)
 
 
 def get_image_location(post_id):
@@ -87,50 +36,154 @@ def get_image_location(post_id):
     :return:            List of image file paths in /content/images/generated/title with the post ID
     :rtype:             list(str)
     """
-    cur_folder_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1])
-    title_path = "".join([cur_folder_path, "/content/images/generated/title"])
-    all_images_paths = glob.glob(title_path + "*" + post_id + ".jpg")
-    return all_images_paths
-
-
-def upload_posts(record):
-    """
+    return [image['path'] for image in
+            get_manifest().get_images(post_id, kind='title', state='generated')]
+
+
+class InstagramUploader:
+    def __init__(self, min_interval=None, max_retries=3, backoff=30):
+        """
+        Uploads through a single Instagram session, restored from the cookies of earlier runs
+        :param min_interval:    Seconds between two uploads, defaults to upload_min_interval in
+                                credentials.py or DEFAULT_MIN_UPLOAD_INTERVAL
+        :param max_retries:     Attempts after the first one before giving up on a post
+        :param backoff:         Seconds to wait before the first retry, doubled on every retry
+        """
+        from insta_reddit import credentials  # Only needed once an upload is set up
+        if min_interval is None:
+            min_interval = getattr(credentials, "upload_min_interval", DEFAULT_MIN_UPLOAD_INTERVAL)
+        self.rate_limiter = RateLimiter(rate=1.0 / max(min_interval, 1e-3))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bot = None
+
+    def get_bot(self):
+        """
+        Logs in once per process; instabot keeps the session cookies in its config folder
+        under content/instabot, so later runs reuse them instead of doing a full login
+        """
+        if self.bot is None:
+            from instabot import Bot  # Slow to import, only needed once something gets uploaded
+            from insta_reddit import credentials
+            METRICS.increment("instagram_logins")
+            bot = Bot(base_path=get_content_folder_path() + "/content/instabot/")
+            if not bot.login(username=credentials.instabot_username,
+                             password=credentials.instabot_password,
+                             use_cookie=True):
+                raise Exception("Instagram login failed.")
+            self.bot = bot
+        return self.bot
+
+    def upload(self, record, caption=None):
+        """
+        Upload the image generated for a record, retrying with exponential backoff and jitter
+        :param dict record: dict containing 'id', 'title', 'selftext', 'author', 'url' in its keys
+        :param str caption: Caption to upload with, generated from the record if None
+        :return:            True if the image was uploaded
+        :rtype:             bool
+        """
+        images = get_image_location(record['id'])
+        if not images:
+            print("Image file not found for ID: {}".format(record['id']))
+            return False
+        if len(images) == 2:  # contains title + selftext
+            print("No support yet for multiple image uploads.")
+            return False
+
+        caption = caption or get_caption_store().get_caption(record['id']) or get_caption(record)
+        uploaded = False
+        for attempt in range(self.max_retries + 1):
+            METRICS.observe("upload_rate_limit_wait", self.rate_limiter.acquire())
+            try:
+                bot = self.get_bot()
+                with METRICS.timer("upload"):
+                    # instabot renames uploaded photos to .REMOVE_ME unless told not to,
+                    # they are moved to the uploaded folder instead
+                    uploaded = bot.upload_photo(images[0], caption=caption,
+                                                options={"rename": False})
+                if uploaded:
+                    break
+                print("Upload of {} failed.".format(record['id']))
+            except Exception as e:
+                print("Upload of {} failed: {}".format(record['id'], e))
+                self.bot = None  # Log in again, the session may have expired
+            METRICS.increment("uploads", result="failure")
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+        if not uploaded:
+            return False
+
+        METRICS.increment("uploads", result="success")
+        try:
+            move_to_uploaded(images[0])
+        except Exception as e:
+            # The post is online all the same, it must not be uploaded again
+            print("Failed to move the image of {} to uploaded: {}".format(record['id'], e))
+        return True
 
-    :param record:
-    :return:
+    def upload_all(self, records, on_uploaded=None):
+        """
+        Drain a queue of records as fast as the rate limiter allows
+        :param list records:    Records to upload, in order
+        :param on_uploaded:     Called with each record once it is uploaded
+        :return:                Number of records uploaded
+        """
+        pending = deque(records)
+        uploaded = 0
+        while pending:
+            record = pending.popleft()
+            if self.upload(record):
+                uploaded += 1
+                if on_uploaded is not None:
+                    on_uploaded(record)
+        return uploaded
+
+
+_uploader = None
+
+
+def get_uploader():
+    """ Returns the uploader shared by the whole process
     """
-    bot = Bot()
-    bot.login(username=credentials.instabot_username,
-              password=credentials.instabot_password)
+    global _uploader
+    if _uploader is None:
+        _uploader = InstagramUploader()
+    return _uploader
 
-    images = get_image_location(record['id'])
-    if not images:
-        print("Image file not found for ID: {}".format(record['id']))
-        return False
 
-    if len(images) == 1:  # contains only title
-        bot.upload_photo(images[0], caption=get_caption(record))
-        return True
-    elif len(images) == 2:  # contains title + selftext
-        print("No support yet for multiple image uploads.")
-        return False
+def upload_posts(record, caption=None):
+    """
+    Upload the image generated for a record, reusing the session of the process
+    :param dict record: dict containing 'id', 'title', 'selftext', 'author', 'url' in its keys
+    :param str caption: Caption to upload with, generated from the record if None
+    :return:            True if the image was uploaded
+    :rtype:             bool
+    """
+    return get_uploader().upload(record, caption)
 
 
 def main(args):
-    credentials_path = "/".join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + \
-                       "/service_account.json"
-    sdb = SheetsDb(sheet_id=credentials.sheets_url,
-                   credentials_path=credentials_path)
-    unuploaded_posts = sdb.get_unuploaded_rows()
-    for unuploaded_post in unuploaded_posts[:int(args.post_count)]:
-        post_id = unuploaded_post['id']
-        upload_posts(unuploaded_post)
-        sdb.update_image_uploaded(post_id)
+    global _uploader
+    _uploader = InstagramUploader(min_interval=None if args.min_interval is None
+                                  else float(args.min_interval),
+                                  max_retries=int(args.max_retries))
+    # Status updates are buffered and flushed in one batch when the block exits, even on error
+    with get_db(buffered=True) as sdb:
+        # Posts that couldn't be rendered, e.g. too long, never get an image: leave them out
+        # so they don't hold up the posts behind them
+        posts = [post for post in sdb.get_unuploaded_rows()
+                 if get_image_location(post['id'])][:int(args.post_count)]
+        get_caption_store().precompute(posts)  # No-op for posts captioned ahead by captions.py
+        uploaded = _uploader.upload_all(posts,
+                                        on_uploaded=lambda post: sdb.update_image_uploaded(
+                                            post['id']))
+    print("Uploaded {} posts.".format(uploaded))
+    sync_mirror(sdb)
 
 
 if __name__ == "__main__":
+    from insta_reddit.cli import add_upload_arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--post_count', dest='post_count', default=1,
-                        help="""Number of posts to post at one call""")
+    add_upload_arguments(parser)
     main(args=parser.parse_args())
     sys.exit(0)